@@ -1,9 +1,19 @@
 from dataclasses import dataclass
-from datetime import date
+from datetime import date, datetime, time, timedelta
+
+from weather.sweep import get_sweep_dates
 
 
 @dataclass
 class Launch:
     name: str
     date: date
-    time: str = "18:80"
+    time: str = "18:00"
+
+    def get_datetime(self) -> datetime:
+        hours, minutes = self.time.split(":")
+        return datetime.combine(self.date, time(int(hours), int(minutes)))
+
+    def get_window_dates(self, window: timedelta, step: timedelta) -> list[datetime]:
+        """Gets the forecast times across a launch window opening at the launch time."""
+        return get_sweep_dates(self.get_datetime(), window, step)
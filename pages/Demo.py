@@ -1,49 +1,136 @@
 import streamlit as st
 import datetime
+import os
 from dataclasses import dataclass
-from weather.data import get_inputs_patch, get_labels_patch
-from weather.model import WeatherModel
+from functools import partial
+from weather.data import get_forecast_patches
+from weather.metrics import get_breakdown, metrics
+from weather.runtime import load_engine
+from weather.registry import ModelRegistry, get_weights_size
+from weather.singleflight import SingleFlight
+from weather.sweep import forecast_sweep
 from visualize import show_inputs, show_outputs
 from launch import Launch
 
+# One of weather.runtime.BACKENDS, the exported ones need `python -m weather.export` first.
+BACKEND = os.environ.get("WEATHER_BACKEND", "torch")
+# One of weather.runtime.PRECISIONS, quantized ones need `python -m weather.quantize` first.
+PRECISION = os.environ.get("WEATHER_PRECISION", "fp32")
+# The ensemble runs all the models in a single pass, it needs the pretrained weights.
+ENSEMBLE = "ensemble"
+# Least recently used models are unloaded over this budget, or after being idle this long.
+MODELS_MAX_BYTES = int(os.environ.get("WEATHER_MODELS_MAX_BYTES", 1024**3))
+MODELS_MAX_IDLE = float(os.environ.get("WEATHER_MODELS_MAX_IDLE", 3600))
+# Torch models can run in a pool of processes sharing their weights, see weather.pool.
+WORKERS = int(os.environ.get("WEATHER_WORKERS", 0)) or None
+
 @dataclass
 class Model:
     name: str
-    model: WeatherModel
+    model_dirs: list[str]
+
+models = {
+    "26_5_epochs_tropics": Model(name="2/6 1000 Epochs, Americas", model_dirs=["models/26_1000_epochs_americas"]),
+    "26_100_epochs_americas": Model(name="2/6 100 Epochs, Americas", model_dirs=["models/26_100_epochs_americas"]),
+    "26_100_epochs_tropics": Model(name="2/6 100 Epochs, Tropics", model_dirs=["models/26_100_epochs_tropics"]),
+}
+if BACKEND == "torch" and PRECISION == "fp32":
+    models[ENSEMBLE] = Model(name="Ensemble, All Models", model_dirs=[
+        "models/26_1000_epochs_americas",
+        "models/26_100_epochs_americas",
+        "models/26_100_epochs_tropics",
+    ])
+
+
+def load_model(id):
+    if id == ENSEMBLE:
+        from weather.ensemble import load_ensemble
+        return load_ensemble(models[id].model_dirs, num_workers=WORKERS)
+    return load_engine(models[id].model_dirs[0], BACKEND, precision=PRECISION, num_workers=WORKERS)
+
+
+@st.cache_resource
+def load_registry():
+    # Models are only loaded when they're first selected, so the app starts quickly.
+    registry = ModelRegistry(MODELS_MAX_BYTES, MODELS_MAX_IDLE)
+    for id, model in models.items():
+        size = sum(get_weights_size(model_dir) for model_dir in model.model_dirs)
+        registry.register(id, partial(load_model, id), size)
+    return registry
+
 
 @st.cache_resource
-def load_models():
-    models = {
-        "26_5_epochs_tropics": Model(name="2/6 1000 Epochs, Americas", model=WeatherModel.from_pretrained("models/26_1000_epochs_americas")),
-        "26_100_epochs_americas": Model(name="2/6 100 Epochs, Americas", model=WeatherModel.from_pretrained("models/26_100_epochs_americas")),
-        "26_100_epochs_tropics": Model(name="2/6 100 Epochs, Tropics", model=WeatherModel.from_pretrained("models/26_100_epochs_tropics")),
-    }
-    
-    return models
+def load_flights():
+    # Shared by every session, so identical forecasts requested at once only run once.
+    return SingleFlight()
+
+
+POINT = (-80.607, 28.392)  # (longitude, latitude)
+PATCH_SIZE = 128
 
 
 def predict() -> None:
-    point = (-80.607, 28.392)  # (longitude, latitude)
-    patch_size = 128
-    time = datetime.datetime.strptime(st.session_state.t, "%H:%M").time()
-    dt = datetime.datetime.combine(st.session_state.d, time)
-    st.session_state.i = get_inputs_patch(
+    # Time each stage of the prediction to show where the latency goes.
+    before = metrics.snapshot()
+    try:
+        if st.session_state.sweep:
+            predict_sweep()
+        else:
+            predict_forecast()
+    finally:
+        st.session_state.breakdown = get_breakdown(before, metrics.snapshot())
+
+
+def predict_forecast() -> None:
+    st.session_state.pop("sweep_result", None)
+    dt = Launch(name="", date=st.session_state.d, time=st.session_state.t).get_datetime()
+    model_name = st.session_state.model_name
+    (st.session_state.i, st.session_state.labels, predictions), _ = flights.do(
+        ("forecast", model_name, dt), run_forecast, model_name, dt
+    )
+    if st.session_state.model_name == ENSEMBLE:
+        from weather.ensemble import EnsembleForecast
+        forecast = EnsembleForecast.from_members(predictions)
+        st.session_state.predictions = forecast.mean
+        st.session_state.spread = forecast.spread
+    else:
+        st.session_state.predictions = predictions
+        st.session_state.pop("spread", None)
+
+
+def run_forecast(model_name, dt):
+    inputs, labels = get_forecast_patches(
         dt,
-        point,
-        patch_size,
+        POINT,
+        PATCH_SIZE,
     )
+    return inputs, labels, registry.get(model_name).predict(inputs)
 
-    st.session_state.predictions = models[st.session_state.model_name].model.predict(st.session_state.i)
-    st.session_state.labels = get_labels_patch(dt, point, patch_size)
+
+def predict_sweep() -> None:
+    # Every forecast time across the window is fetched and predicted as one batch.
+    launch = Launch(name="", date=st.session_state.d, time=st.session_state.t)
+    dates = launch.get_window_dates(
+        datetime.timedelta(hours=st.session_state.window_hours),
+        datetime.timedelta(minutes=st.session_state.step_minutes),
+    )
+    model_name = st.session_state.model_name
+    st.session_state.sweep_result, _ = flights.do(
+        ("sweep", model_name, tuple(dates)), run_sweep, model_name, dates
+    )
+    st.session_state.pop("i", None)
+
+
+def run_sweep(model_name, dates):
+    return forecast_sweep(registry.get(model_name), dates, POINT, PATCH_SIZE, labels=True)
 
 
 def reset():
     if st.session_state.input_type == "customtime":
         st.session_state.d = datetime.date(2022, 9, 30)
         st.session_state.t = "18:00"
-        del st.session_state["predictions"]
-        del st.session_state["i"]
-        del st.session_state["labels"]
+        for key in ["predictions", "i", "labels", "spread", "sweep_result", "breakdown"]:
+            st.session_state.pop(key, None)
     else:
         st.session_state.d = launches[st.session_state.input_type].date
         st.session_state.t = launches[st.session_state.input_type].time if launches[st.session_state.input_type].time else "18:00"
@@ -56,6 +143,11 @@ if "input_type" not in st.session_state:
 if "model_name" not in st.session_state:
     st.session_state.model_name = "26_100_epochs_tropics"
 
+if "sweep" not in st.session_state:
+    st.session_state.sweep = False
+    st.session_state.window_hours = 4.0
+    st.session_state.step_minutes = 30
+
 launches = {
     "crew2demo": Launch(name="Crew 2 Demo", date=datetime.date(2020, 9, 30), time="18:00"),
     "starlink12": Launch(name="Falcon 9 Starlink-12", date=datetime.date(2020, 5, 10), time="18:00"),
@@ -68,13 +160,12 @@ def format_launch(id):
     return "Custom Time" if id == "customtime" else launches[id].name
 
 def format_model(id):
-    print(models)
     return models[id].name
 
 
-models = load_models()
+registry = load_registry()
+flights = load_flights()
 
-print(list(models.keys()))
 st.sidebar.selectbox("Model", key="model_name", options=list(models.keys()), format_func=format_model, on_change=reset)
 
 st.sidebar.selectbox(
@@ -85,9 +176,15 @@ st.sidebar.selectbox(
     on_change=reset,
 )
 
+st.sidebar.checkbox("Sweep Launch Window", key="sweep", on_change=reset)
+st.sidebar.number_input("Window (hours)", key="window_hours", min_value=0.5, max_value=12.0, step=0.5, disabled=not st.session_state.sweep, on_change=reset)
+st.sidebar.number_input("Step (minutes)", key="step_minutes", min_value=10, max_value=120, step=10, disabled=not st.session_state.sweep, on_change=reset)
+
 
 st.write("# Demo")
 
+render_before = metrics.snapshot()
+
 if "i" in st.session_state:
     if st.checkbox("Input Data"):
         st.plotly_chart(show_inputs(st.session_state.i))
@@ -109,6 +206,23 @@ if st.session_state.input_type == "customtime":
     st.button("Predict Weather", on_click=predict)
 
 
+if "sweep_result" in st.session_state:
+    sweep = st.session_state.sweep_result
+    k = st.select_slider(
+        "Forecast Time (UTC)",
+        options=list(range(len(sweep.dates))),
+        format_func=lambda k: sweep.dates[k].strftime("%Y-%m-%d %H:%M"),
+    )
+    st.session_state.labels = sweep.labels[k]
+    if st.session_state.model_name == ENSEMBLE:
+        from weather.ensemble import EnsembleForecast
+        forecast = EnsembleForecast.from_members(sweep.predictions[k])
+        st.session_state.predictions = forecast.mean
+        st.session_state.spread = forecast.spread
+    else:
+        st.session_state.predictions = sweep.predictions[k]
+        st.session_state.pop("spread", None)
+
 st.write(
     """
 ## Predictions
@@ -117,6 +231,14 @@ st.write(
 if "predictions" in st.session_state:
     st.plotly_chart(show_outputs(st.session_state.predictions))
 
+if "spread" in st.session_state:
+    st.write(
+        """
+## Ensemble Spread
+             """
+    )
+    st.plotly_chart(show_outputs(st.session_state.spread))
+
 st.write(
     """
 ## Actual
@@ -125,3 +247,17 @@ st.write(
 
 if "labels" in st.session_state:
     st.plotly_chart(show_outputs(st.session_state.labels))
+
+
+def show_breakdown(breakdown):
+    st.sidebar.write("### Latency Breakdown")
+    st.sidebar.table({
+        "Stage": list(breakdown.keys()),
+        "Time (ms)": [f"{seconds * 1000:.1f}" for seconds in breakdown.values()],
+    })
+
+
+# Rendering the charts is timed on every run, the prediction only when it runs.
+breakdown = st.session_state.get("breakdown", {}) | get_breakdown(render_before, metrics.snapshot())
+if breakdown:
+    show_breakdown(breakdown)
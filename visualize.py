@@ -1,47 +1,92 @@
 # Adapted from https://github.com/GoogleCloudPlatform/python-docs-samples/tree/main/people-and-planet-ai/weather-forecasting
 
+import base64
+from functools import lru_cache
+import io
+
+from PIL import Image
 from plotly.graph_objects import Figure
 import plotly.graph_objects as graph_objects
 from plotly.subplots import make_subplots
 import numpy as np
 
+from weather.metrics import span
+
+GPM_PALETTE = (
+    "000096",  # Navy blue
+    "0064ff",  # Blue ribbon blue
+    "00b4ff",  # Dodger blue
+    "33db80",  # Shamrock green
+    "9beb4a",  # Conifer green
+    "ffeb00",  # Turbo yellow
+    "ffb300",  # Selective yellow
+    "ff6400",  # Blaze orange
+    "eb1e00",  # Scarlet red
+    "af0000",  # Bright red
+)
+
+ELEVATION_PALETTE = (
+    "000000",  # Black
+    "478fcd",  # Shakespeare blue
+    "86c58e",  # De York green
+    "afc35e",  # Celery green
+    "8f7131",  # Pesto brown
+    "b78d4f",  # Muddy waters brown
+    "e2b8a6",  # Rose fog pink
+    "ffffff",  # White
+)
+
+# Band offsets of each GOES 16 frame in the inputs, and its (red, green, blue)
+# bands: CMI_C02, CMI_C03 and CMI_C01.
+GOES16_OFFSETS = [3, 19, 35]
+GOES16_RGB = [1, 2, 0]
+
 
 def show_outputs(patch: np.ndarray) -> Figure:
-    fig = make_subplots(rows=1, cols=2)
-    fig.add_trace(graph_objects.Image(z=render_gpm(patch[:, :, 0:1])), row=1, col=1)
-    fig.add_trace(graph_objects.Image(z=render_gpm(patch[:, :, 1:2])), row=1, col=2)
-    fig.update_layout(height=300, margin=dict(l=0, r=0, b=0, t=0))
-    return fig
+    with span("render_outputs"):
+        images = render_gpm(patch[:, :, 0:2])
+        fig = make_subplots(rows=1, cols=2)
+        fig.add_trace(show_image(images[0]), row=1, col=1)
+        fig.add_trace(show_image(images[1]), row=1, col=2)
+        fig.update_layout(height=300, margin=dict(l=0, r=0, b=0, t=0))
+        return fig
+
+
+def show_image(image: np.ndarray) -> graph_objects.Image:
+    """Creates an image trace, sent to the browser as a compressed PNG.
+
+    Args:
+        image: An uint8 array with shape (width, height, rgb).
+
+    Returns: A plotly image trace.
+    """
+    # Optimizing shrinks the payload a little but is much slower to encode.
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="PNG", compress_level=1)
+    data = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return graph_objects.Image(source=f"data:image/png;base64,{data}")
 
 
 def render_gpm(patch: np.ndarray) -> np.ndarray:
-    palette = [
-        "000096",  # Navy blue
-        "0064ff",  # Blue ribbon blue
-        "00b4ff",  # Dodger blue
-        "33db80",  # Shamrock green
-        "9beb4a",  # Conifer green
-        "ffeb00",  # Turbo yellow
-        "ffb300",  # Selective yellow
-        "ff6400",  # Blaze orange
-        "eb1e00",  # Scarlet red
-        "af0000",  # Bright red
-    ]
-    return render_palette(patch[:, :, 0], palette, max=20)
+    """Renders every band of a precipitation patch as a separate image.
 
+    Args:
+        patch: A float array with shape (width, height, bands).
 
-def render_palette(
-    values: np.ndarray, palette: list[str], min: float = 0.0, max: float = 1.0
-) -> np.ndarray:
-    """Renders a NumPy array with shape (width, height, 1) as an image with a palette.
+    Returns: An uint8 array with shape (bands, width, height, rgb).
+    """
+    return render_palette(patch.transpose(2, 0, 1), GPM_PALETTE, max=20)
+
+
+@lru_cache(maxsize=None)
+def get_color_map(palette: tuple[str, ...]) -> np.ndarray:
+    """Creates a color map from a hex color palette, only once per palette.
 
     Args:
-        values: An uint8 array with shape (width, height, 1).
-        palette: List of hex encoded colors.
+        palette: Tuple of hex encoded colors.
 
-    Returns: An uint8 array with shape (width, height, rgb) with colors from the palette.
+    Returns: A read-only uint8 array with shape (256, rgb).
     """
-    # Create a color map from a hex color palette.
     xs = np.linspace(0, len(palette), 256)
     indices = np.arange(len(palette))
 
@@ -49,50 +94,68 @@ def render_palette(
     green = np.interp(xs, indices, [int(c[2:4], 16) for c in palette])
     blue = np.interp(xs, indices, [int(c[4:6], 16) for c in palette])
     color_map = np.array([red, green, blue]).astype(np.uint8).transpose()
+    color_map.flags.writeable = False
+    return color_map
+
+
+def render_palette(
+    values: np.ndarray, palette: list[str], min: float = 0.0, max: float = 1.0
+) -> np.ndarray:
+    """Renders a NumPy array of any shape as an image with a palette.
+
+    Args:
+        values: A float array, like (width, height) or (images, width, height).
+        palette: List of hex encoded colors.
 
+    Returns: An uint8 array with an extra rgb axis with colors from the palette.
+    """
+    color_map = get_color_map(tuple(palette))
     scaled_values = (values - min) / (max - min)
     color_indices = (scaled_values.clip(0, 1) * 255).astype(np.uint8)
     return np.take(color_map, color_indices, axis=0)
 
 
 def show_inputs(patch: np.ndarray) -> Figure:
-    fig = make_subplots(rows=2, cols=4)
-    fig.add_trace(graph_objects.Image(z=render_gpm(patch[:, :, 0:1])), row=1, col=1)
-    fig.add_trace(graph_objects.Image(z=render_gpm(patch[:, :, 1:2])), row=1, col=2)
-    fig.add_trace(graph_objects.Image(z=render_gpm(patch[:, :, 2:3])), row=1, col=3)
-    fig.add_trace(graph_objects.Image(z=render_goes16(patch[:, :, 3:19])), row=2, col=1)
-    fig.add_trace(
-        graph_objects.Image(z=render_goes16(patch[:, :, 19:35])), row=2, col=2
-    )
-    fig.add_trace(
-        graph_objects.Image(z=render_goes16(patch[:, :, 35:51])), row=2, col=3
-    )
-    fig.add_trace(
-        graph_objects.Image(z=render_elevation(patch[:, :, 51:52])), row=1, col=4
-    )
-    fig.update_layout(height=500, margin=dict(l=0, r=0, b=0, t=0))
-    return fig
+    with span("render_inputs"):
+        gpm = render_gpm(patch[:, :, 0:3])
+        goes16 = render_goes16(patch)
+        elevation = render_elevation(patch[:, :, 51:52])
+        fig = make_subplots(rows=2, cols=4)
+        fig.add_trace(show_image(gpm[0]), row=1, col=1)
+        fig.add_trace(show_image(gpm[1]), row=1, col=2)
+        fig.add_trace(show_image(gpm[2]), row=1, col=3)
+        fig.add_trace(show_image(goes16[0]), row=2, col=1)
+        fig.add_trace(show_image(goes16[1]), row=2, col=2)
+        fig.add_trace(show_image(goes16[2]), row=2, col=3)
+        fig.add_trace(show_image(elevation), row=1, col=4)
+        fig.update_layout(height=500, margin=dict(l=0, r=0, b=0, t=0))
+        return fig
 
 
 def render_goes16(patch: np.ndarray) -> np.ndarray:
-    red = patch[:, :, 1]  # CMI_C02
-    green = patch[:, :, 2]  # CMI_C03
-    blue = patch[:, :, 0]  # CMI_C01
-    rgb_patch = np.stack([red, green, blue], axis=-1)
-    return render_rgb_images(rgb_patch, max=3000)
+    """Renders every GOES 16 frame of an inputs patch as an RGB image.
+
+    Args:
+        patch: A float array with shape (width, height, channels).
+
+    Returns: An uint8 array with shape (frames, width, height, rgb).
+    """
+    bands = [offset + band for offset in GOES16_OFFSETS for band in GOES16_RGB]
+    frames = patch[:, :, bands].reshape(patch.shape[:2] + (len(GOES16_OFFSETS), 3))
+    return render_rgb_images(frames.transpose(2, 0, 1, 3), max=3000)
 
 
 def render_rgb_images(
     values: np.ndarray, min: float = 0.0, max: float = 1.0
 ) -> np.ndarray:
-    """Renders a numeric NumPy array with shape (width, height, rgb) as an image.
+    """Renders a numeric NumPy array with shape (..., width, height, rgb) as images.
 
     Args:
-        values: A float array with shape (width, height, rgb).
+        values: A float array with shape (..., width, height, rgb).
         min: Minimum value in the values.
         max: Maximum value in the values.
 
-    Returns: An uint8 array with shape (width, height, rgb).
+    Returns: An uint8 array with shape (..., width, height, rgb).
     """
     scaled_values = (values - min) / (max - min)
     rgb_values = scaled_values.clip(0, 1) * 255
@@ -100,14 +163,4 @@ def render_rgb_images(
 
 
 def render_elevation(patch: np.ndarray) -> np.ndarray:
-    palette = [
-        "000000",  # Black
-        "478fcd",  # Shakespeare blue
-        "86c58e",  # De York green
-        "afc35e",  # Celery green
-        "8f7131",  # Pesto brown
-        "b78d4f",  # Muddy waters brown
-        "e2b8a6",  # Rose fog pink
-        "ffffff",  # White
-    ]
-    return render_palette(patch[:, :, 0], palette, max=3000)
+    return render_palette(patch[:, :, 0], ELEVATION_PALETTE, max=3000)
@@ -0,0 +1,508 @@
+"""Benchmarks of the prediction pipeline that run offline.
+
+Instead of Earth Engine, patches are downloaded from a local stand-in server
+serving synthetic NPY files in the same structured format, with configurable
+latency and rate of "429: Too Many Requests" errors. It serves both download
+URLs and computePixels requests, compressed like Earth Engine if asked to.
+This exercises the real download, decoding and caching code of both paths,
+so results are reproducible and can be compared across commits.
+
+To run all the benchmarks and save the results:
+
+    python -m weather.benchmark --output benchmark.json
+
+The results are JSON, with the timings of every benchmark in seconds.
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass
+from datetime import datetime
+import gzip
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any as AnyType, Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from weather import data
+from weather.cache import PatchCache
+from weather.data import INPUT_BANDS, LABEL_BANDS, GOES16_BANDS, EarthEngineSource
+from weather.metrics import metrics
+from weather.npy import read_npy
+
+
+def create_npy(bands: int, width: int, height: int, seed: int = 0) -> bytes:
+    """Creates a synthetic NPY file like the ones Earth Engine serves.
+
+    Earth Engine serves a structured array with one float32 field per band.
+    """
+    dtype = np.dtype([(f"b{i}", "<f4") for i in range(bands)])
+    values = np.random.default_rng(seed).random((height, width, bands), np.float32)
+    buffer = io.BytesIO()
+    np.save(buffer, values.view(dtype)[:, :, 0])
+    return buffer.getvalue()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves synthetic patches like Earth Engine.
+
+    Download URLs are minted at GET /download_url and downloaded from
+    GET /npy, both with the query ?bands=B&width=W&height=H. computePixels
+    requests are POST /v1/projects/P/image:computePixels with the bands in the
+    expression of a `StandInImage`.
+    """
+
+    server: StandInServer
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path == "/download_url":
+            # Minting a download URL is a round trip of its own.
+            time.sleep(self.server.latency)
+            body = f"{self.server.url}/npy?{url.query}".encode()
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        query = {k: int(v[0]) for k, v in parse_qs(url.query).items()}
+        self.send_npy(query["bands"], query["width"], query["height"])
+
+    def do_POST(self) -> None:
+        if not self.path.endswith("/image:computePixels"):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        dimensions = request["grid"]["dimensions"]
+        bands = request["expression"]["bands"]
+        self.send_npy(bands, dimensions["width"], dimensions["height"])
+
+    def send_npy(self, bands: int, width: int, height: int) -> None:
+        time.sleep(self.server.latency)
+        if self.server.should_throttle():
+            self.send_error(HTTPStatus.TOO_MANY_REQUESTS)
+            return
+
+        # Like Google APIs, only compress for user agents that ask for gzip.
+        compress = "gzip" in self.headers.get("Accept-Encoding", "") and (
+            "gzip" in self.headers.get("User-Agent", "")
+        )
+        body = self.server.get_npy(bands, width, height, compress)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/octet-stream")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: AnyType) -> None:
+        pass  # don't log every request
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local stand-in for Earth Engine downloads.
+
+    Args:
+        latency: Seconds to wait before responding to each request.
+        error_rate: Fraction of requests answered with "429: Too Many Requests".
+        seed: Seed for which requests get errors.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0
+    ) -> None:
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.files: dict[tuple[int, int, int, bool], bytes] = {}
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def compute_pixels_url(self) -> str:
+        return f"{self.url}/v1/projects/stand-in/image:computePixels"
+
+    def should_throttle(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def get_npy(self, bands: int, width: int, height: int, compress: bool) -> bytes:
+        with self.lock:
+            key = (bands, width, height, compress)
+            if key not in self.files:
+                body = create_npy(bands, width, height)
+                self.files[key] = gzip.compress(body) if compress else body
+            return self.files[key]
+
+    def __enter__(self) -> StandInServer:
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args: AnyType) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+@dataclass
+class StandInImage:
+    """Stands in for an `ee.Image`, downloading from a `StandInServer`."""
+
+    url: str
+    bands: int
+    name: str
+
+    def serialize(self, for_cloud_api: bool = True) -> str:
+        return json.dumps({"bands": self.bands, "name": self.name})
+
+    def getDownloadURL(self, params: dict) -> str:
+        width, height = params["dimensions"]
+        query = f"bands={self.bands}&width={width}&height={height}"
+        response = data.session.get(f"{self.url}/download_url?{query}")
+        response.raise_for_status()
+        return response.text
+
+
+@dataclass
+class StandInRegion:
+    """Stands in for an `ee.Geometry`."""
+
+    name: str
+
+    def serialize(self) -> str:
+        return self.name
+
+
+class StandInSource(EarthEngineSource):
+    """Earth Engine source downloading from a `StandInServer`.
+
+    Every request is unique unless `cached` is set, so nothing is served
+    from the patch cache. Patches are fetched with computePixels requests if
+    `compute_pixels` is set, see `use_stand_in`, or download URLs otherwise.
+    """
+
+    def __init__(
+        self, url: str, cached: bool = False, compute_pixels: bool = False
+    ) -> None:
+        super().__init__(compute_pixels, point_grid=True)
+        self.url = url
+        self.cached = cached
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def get_stacked_patch(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        point: tuple,
+        patch_size: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        bands = len(gpm_dates) + GOES16_BANDS * len(goes16_dates) + int(elevation)
+        with self.lock:
+            self.counter += 1
+            name = json.dumps([str(gpm_dates), str(goes16_dates), elevation])
+            if not self.cached:
+                name += f" #{self.counter}"
+        image = StandInImage(self.url, bands, name)
+        if self.compute_pixels:
+            bounds = data.get_point_bounds(point, patch_size, data.SCALE)
+            return data.get_grid_patch(image, bounds, (patch_size, patch_size), out)
+        region = StandInRegion(f"{point} {patch_size}")
+        return data.get_region_patch(image, region, (patch_size, patch_size), out)
+
+
+def measure(
+    fn: Callable[[], AnyType], repeat: int = 10, warmup: int = 1
+) -> dict[str, float]:
+    """Times a function.
+
+    Returns: Summary statistics of the wall time in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        "min": times[0],
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "p95": times[min(len(times) - 1, round(0.95 * (len(times) - 1)))],
+        "max": times[-1],
+        "repeat": repeat,
+    }
+
+
+def bench_decode(patch_size: int, repeat: int) -> dict[str, float]:
+    """Times decoding an inputs patch from NPY bytes already in memory."""
+    body = create_npy(INPUT_BANDS, patch_size, patch_size)
+    out = np.empty((patch_size, patch_size, INPUT_BANDS), np.float32)
+    return measure(lambda: read_npy(io.BytesIO(body), out), repeat)
+
+
+def use_stand_in(server: Optional[StandInServer]) -> None:
+    """Sends computePixels requests to a stand-in server, or stops if None."""
+    data.compute_session = data.session if server else None
+    data.compute_url = server.compute_pixels_url if server else None
+
+
+def bench_get_patch(
+    url: str, patch_size: int, cached: bool, compute_pixels: bool, repeat: int
+) -> dict[str, float]:
+    """Times downloading and decoding an inputs patch, or reading it from cache."""
+    source = StandInSource(url, cached, compute_pixels)
+    date = datetime(2020, 9, 30, 18)
+    return measure(lambda: source.get_inputs_patch(date, (0, 0), patch_size), repeat)
+
+
+def bench_get_forecast_patches(
+    url: str, patch_size: int, compute_pixels: bool, repeat: int
+) -> dict[str, float]:
+    """Times getting the inputs and labels of a forecast end to end."""
+    source = StandInSource(url, compute_pixels=compute_pixels)
+    date = datetime(2020, 9, 30, 18)
+    return measure(
+        lambda: data.get_forecast_patches(date, (0, 0), patch_size, source), repeat
+    )
+
+
+def bench_predict_batch(
+    batch_size: int, num_threads: int, patch_size: int, repeat: int
+) -> dict[str, float]:
+    """Times predicting a batch with a randomly initialized model."""
+    import torch
+
+    from weather.inference import InferenceEngine
+    from weather.model import WeatherConfig, WeatherModel
+    from weather.optimize import optimize_for_inference
+
+    torch.manual_seed(0)
+    config = WeatherConfig(
+        mean=[[[[0.5] * INPUT_BANDS]]], std=[[[[0.3] * INPUT_BANDS]]]
+    )
+    model = WeatherModel(config).eval()
+    engine = InferenceEngine(
+        optimize_for_inference(model),
+        num_threads=num_threads,
+        batch_sizes=(batch_size,),
+        patch_size=patch_size,
+    )
+    inputs = np.random.default_rng(0).random(
+        (batch_size, patch_size, patch_size, INPUT_BANDS), np.float32
+    )
+    return measure(lambda: engine.predict_batch(inputs), repeat)
+
+
+# Functions of `visualize` timed by `bench_visualize`.
+VISUALIZE_FUNCTIONS = ("show_inputs", "show_outputs", "render_gpm", "render_goes16")
+
+
+def bench_visualize(name: str, patch_size: int, repeat: int) -> dict[str, float]:
+    """Times rendering the figures of the demo, or one of their images."""
+    import visualize
+
+    rng = np.random.default_rng(0)
+    inputs = rng.random((patch_size, patch_size, INPUT_BANDS), np.float32) * 3000
+    outputs = rng.random((patch_size, patch_size, LABEL_BANDS), np.float32) * 20
+    functions = {
+        "show_inputs": lambda: visualize.show_inputs(inputs),
+        "show_outputs": lambda: visualize.show_outputs(outputs),
+        "render_gpm": lambda: visualize.render_gpm(outputs),
+        "render_goes16": lambda: visualize.render_goes16(inputs),
+    }
+    return measure(functions[name], repeat)
+
+
+def get_environment() -> dict[str, AnyType]:
+    """Describes where the benchmarks ran, to compare results fairly."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_benchmarks(
+    latency: float = 0.05,
+    error_rate: float = 0.0,
+    repeat: int = 10,
+    patch_sizes: tuple[int, ...] = (64, 128),
+    batch_sizes: tuple[int, ...] = (1, 4, 8),
+    thread_counts: tuple[int, ...] = (1, os.cpu_count() or 1),
+    only: Optional[list[str]] = None,
+) -> dict[str, AnyType]:
+    """Runs the benchmarks against a local Earth Engine stand-in.
+
+    Args:
+        latency: Seconds the stand-in waits before every response.
+        error_rate: Fraction of requests the stand-in answers with 429 errors.
+        repeat: Number of timed runs of each benchmark.
+        patch_sizes: Patch sizes to benchmark.
+        batch_sizes: Batch sizes to benchmark predictions with.
+        thread_counts: Numbers of intra-op threads to benchmark predictions with.
+        only: Groups of benchmarks to run, defaults to all of them: "decode",
+            "get_patch", "get_forecast_patches", "predict_batch", "visualize".
+
+    Returns: The environment, settings and timings of every benchmark.
+    """
+    groups = only or [
+        "decode",
+        "get_patch",
+        "get_forecast_patches",
+        "predict_batch",
+        "visualize",
+    ]
+    results = []
+
+    def record(name: str, params: dict, fn: Callable[[], dict]) -> None:
+        print(f"{name} {params}", file=sys.stderr)
+        results.append({"name": name, "params": params, "seconds": fn()})
+
+    with tempfile.TemporaryDirectory() as cache_dir, StandInServer(
+        latency, error_rate
+    ) as server:
+        # Don't read from or write to the real patch cache.
+        data.patch_cache = PatchCache(cache_dir, 1024**3)
+        use_stand_in(server)
+        for size in patch_sizes:
+            params = {"patch_size": size}
+            if "decode" in groups:
+                record("decode", params, lambda: bench_decode(size, repeat))
+            for compute in (False, True):
+                fetch_params = params | {"compute_pixels": compute}
+                if "get_patch" in groups:
+                    for cached in (False, True):
+                        record(
+                            "get_patch",
+                            fetch_params | {"cached": cached},
+                            lambda: bench_get_patch(
+                                server.url, size, cached, compute, repeat
+                            ),
+                        )
+                if "get_forecast_patches" in groups:
+                    record(
+                        "get_forecast_patches",
+                        fetch_params,
+                        lambda: bench_get_forecast_patches(
+                            server.url, size, compute, repeat
+                        ),
+                    )
+            if "predict_batch" in groups:
+                for threads in sorted(set(thread_counts)):
+                    for batch in batch_sizes:
+                        record(
+                            "predict_batch",
+                            params | {"batch_size": batch, "num_threads": threads},
+                            lambda: bench_predict_batch(batch, threads, size, repeat),
+                        )
+            if "visualize" in groups:
+                for name in VISUALIZE_FUNCTIONS:
+                    record(
+                        f"visualize.{name}",
+                        params,
+                        lambda: bench_visualize(name, size, repeat),
+                    )
+        data.patch_cache = None
+        use_stand_in(None)
+        requests = {"requests": server.requests, "errors": server.errors}
+
+    return {
+        "environment": get_environment(),
+        "settings": {
+            "latency": latency,
+            "error_rate": error_rate,
+            "repeat": repeat,
+        },
+        "stand_in": requests,
+        "governor": data.governor.stats(),
+        "stages": {
+            stage: {"count": count, "seconds": seconds}
+            for stage, (count, seconds) in metrics.snapshot().items()
+        },
+        "results": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="JSON file to write, defaults to stdout.")
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--patch-sizes", type=int, nargs="+", default=[64, 128])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--threads", type=int, nargs="+", default=None)
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=[
+            "decode",
+            "get_patch",
+            "get_forecast_patches",
+            "predict_batch",
+            "visualize",
+        ],
+    )
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        latency=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        repeat=args.repeat,
+        patch_sizes=tuple(args.patch_sizes),
+        batch_sizes=tuple(args.batch_sizes),
+        thread_counts=tuple(args.threads or [1, os.cpu_count() or 1]),
+        only=args.only,
+    )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Builds training datasets in bulk, with the same data path as predictions.
+
+Examples are (date, point) pairs sampled deterministically from a seed, so a
+dataset can always be rebuilt exactly. The inputs and labels of each example
+are fetched together in a single request on the shared download pool, and
+written straight into memory-mapped `.npy` shards, so the dataset never has to
+fit in memory. Examples are only downloaded once, so they bypass the frame and
+patch caches instead of evicting what predictions keep there.
+
+Progress is checkpointed after every batch of examples, so if the build is
+interrupted, running the same command again resumes where it stopped. Failed
+examples are also retried on the next run.
+
+To build a dataset:
+
+    python -m weather.builder datasets/tropics \\
+        --start 2019-01-01 --end 2023-01-01 --count 20000
+
+The output directory contains:
+    manifest.json: Parameters of the build, used to check when resuming.
+    examples.npz: The sampled dates and points of every example.
+    progress.npy: Whether each example has been written already.
+    shard-NNNNN/inputs.npy: Inputs with shape (examples, size, size, bands).
+    shard-NNNNN/labels.npy: Labels with shape (examples, size, size, bands).
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+import json
+import logging
+from pathlib import Path
+from typing import Any as AnyType, Optional
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from weather.data import (
+    INPUT_BANDS,
+    LABEL_BANDS,
+    EarthEngineSource,
+    PatchSource,
+    executor,
+    get_forecast_patches,
+)
+from weather.region import TROPICS
+
+MANIFEST_FILENAME = "manifest.json"
+EXAMPLES_FILENAME = "examples.npz"
+PROGRESS_FILENAME = "progress.npy"
+
+
+def sample_examples(
+    start: datetime,
+    end: datetime,
+    bounds: tuple[float, float, float, float],
+    count: int,
+    seed: int = 0,
+) -> tuple[list[datetime], list[tuple[float, float]]]:
+    """Samples random examples, always the same ones for the same seed.
+
+    Args:
+        start: Earliest date to sample.
+        end: Latest date to sample, exclusive.
+        bounds: The (west, south, east, north) region to sample points in.
+        count: Number of examples.
+        seed: Seed of the random generator.
+
+    Returns: The (dates, points) of the examples, dates are on the hour.
+    """
+    west, south, east, north = bounds
+    hours = int((end - start) / timedelta(hours=1))
+    rng = np.random.default_rng(seed)
+    offsets = rng.integers(0, hours, count)
+    longitudes = rng.uniform(west, east, count)
+    latitudes = rng.uniform(south, north, count)
+    dates = [start + timedelta(hours=int(h)) for h in offsets]
+    points = [(float(x), float(y)) for x, y in zip(longitudes, latitudes)]
+    return (dates, points)
+
+
+def open_array(path: Path, shape: tuple[int, ...], dtype: AnyType) -> np.memmap:
+    """Opens a memory-mapped `.npy` file for writing, creating it if needed."""
+    if path.exists():
+        array = open_memmap(path, mode="r+")
+        if array.shape != shape or array.dtype != np.dtype(dtype):
+            raise ValueError(f"Expected {path} to have shape {shape}")
+        return array
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+def get_shard_dir(directory: str | Path, shard: int) -> Path:
+    """Gets the directory of a shard."""
+    return Path(directory) / f"shard-{shard:05d}"
+
+
+def build_dataset(
+    directory: str | Path,
+    start: datetime,
+    end: datetime,
+    count: int,
+    bounds: tuple[float, float, float, float] = TROPICS,
+    patch_size: int = 128,
+    shard_size: int = 1024,
+    seed: int = 0,
+    batch_size: int = 64,
+    source: Optional[PatchSource] = None,
+) -> int:
+    """Builds a dataset of inputs and labels, or resumes building it.
+
+    Args:
+        directory: Directory to write the dataset into.
+        start: Earliest date to sample.
+        end: Latest date to sample, exclusive.
+        count: Number of examples.
+        bounds: The (west, south, east, north) region to sample points in.
+        patch_size: Size in pixels of each square patch.
+        shard_size: Number of examples per shard.
+        seed: Seed to sample the examples with.
+        batch_size: Number of examples to fetch between checkpoints.
+        source: Where to get the patches from, defaults to Earth Engine
+            without any caching.
+
+    Raises:
+        ValueError: If the directory has a dataset built with other parameters.
+
+    Returns: The number of examples that failed and are still missing.
+    """
+    source = source or EarthEngineSource(cache=False)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest = {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "count": count,
+        "bounds": list(bounds),
+        "patch_size": patch_size,
+        "shard_size": shard_size,
+        "seed": seed,
+    }
+    manifest_path = directory / MANIFEST_FILENAME
+    if manifest_path.exists():
+        existing = json.loads(manifest_path.read_text())
+        if existing != manifest:
+            raise ValueError(f"{directory} has a dataset built with {existing}")
+    else:
+        manifest_path.write_text(json.dumps(manifest, indent=2))
+
+    dates, points = sample_examples(start, end, bounds, count, seed)
+    np.savez(
+        directory / EXAMPLES_FILENAME,
+        dates=np.array(dates, "datetime64[s]"),
+        points=np.array(points, np.float64),
+    )
+    progress = open_array(directory / PROGRESS_FILENAME, (count,), np.bool_)
+    logging.info("%d of %d examples already built", progress.sum(), count)
+
+    for shard_start in range(0, count, shard_size):
+        shard_stop = min(shard_start + shard_size, count)
+        pending = [i for i in range(shard_start, shard_stop) if not progress[i]]
+        if not pending:
+            continue
+
+        shard_dir = get_shard_dir(directory, shard_start // shard_size)
+        shape = (shard_stop - shard_start, patch_size, patch_size)
+        inputs = open_array(shard_dir / "inputs.npy", shape + (INPUT_BANDS,), "f4")
+        labels = open_array(shard_dir / "labels.npy", shape + (LABEL_BANDS,), "f4")
+
+        def fetch(i: int) -> None:
+            j = i - shard_start
+            patches = get_forecast_patches(dates[i], points[i], patch_size, source)
+            inputs[j], labels[j] = patches
+
+        for batch_start in range(0, len(pending), batch_size):
+            batch = pending[batch_start : batch_start + batch_size]
+            futures: list[Future] = [executor.submit(fetch, i) for i in batch]
+            done = []
+            for i, future in zip(batch, futures):
+                try:
+                    future.result()
+                    done.append(i)
+                except Exception:
+                    logging.exception("Failed example %d at %s", i, dates[i])
+
+            # Only mark examples as done once their pixels are on disk.
+            inputs.flush()
+            labels.flush()
+            progress[done] = True
+            progress.flush()
+            logging.info("%d of %d examples built", progress.sum(), count)
+
+    return int(count - progress.sum())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="Directory to write the dataset into.")
+    parser.add_argument("--start", required=True, type=datetime.fromisoformat)
+    parser.add_argument("--end", required=True, type=datetime.fromisoformat)
+    parser.add_argument("--count", required=True, type=int)
+    parser.add_argument(
+        "--bounds",
+        nargs=4,
+        type=float,
+        default=TROPICS,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+    )
+    parser.add_argument("--patch-size", type=int, default=128)
+    parser.add_argument("--shard-size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    missing = build_dataset(
+        args.directory,
+        args.start,
+        args.end,
+        args.count,
+        tuple(args.bounds),
+        args.patch_size,
+        args.shard_size,
+        args.seed,
+    )
+    if missing:
+        logging.warning("%d examples failed, run again to retry them", missing)
+
+
+if __name__ == "__main__":
+    main()
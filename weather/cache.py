@@ -0,0 +1,161 @@
+"""Persistent on-disk cache for patches of pixels.
+
+Historical imagery never changes, so once a patch has been downloaded it can
+be served from disk instead of going back to Earth Engine. Entries are stored
+as `.npy` files named after a hash of the request, and are read back as
+memory-mapped arrays so only the pages that are actually used get loaded.
+
+With a packing, entries are stored as half size `.npk` files instead, see
+`weather.packing`, and decoded back to float32 when they're read.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+from typing import Any as AnyType, Optional
+
+import numpy as np
+
+from weather.packing import PackedPatch, load_packed, pack, save_packed
+
+
+def cache_key(**fields: AnyType) -> str:
+    """Creates a content-addressed key from a request description.
+
+    Args:
+        fields: JSON serializable values that fully describe the request.
+
+    Returns: A hex digest that uniquely identifies the request.
+    """
+    data = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class PatchCache:
+    """A size-capped directory of `.npy` files with LRU eviction.
+
+    The recency of each entry is tracked by its file modification time,
+    so the eviction order survives restarts.
+
+    Args:
+        directory: Directory to store the cache entries in.
+        max_bytes: Maximum total size of the entries before evicting.
+        packing: Optional packing to store new entries with, see `weather.packing`.
+    """
+
+    def __init__(
+        self, directory: str | Path, max_bytes: int, packing: Optional[str] = None
+    ) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.packing = packing
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        # Maps each key to its size in bytes, from least to most recently used.
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.packed: set[str] = set()  # keys stored as packed entries
+        paths = [*self.directory.glob("*.npy"), *self.directory.glob("*.npk")]
+        for path in sorted(paths, key=lambda p: p.stat().st_mtime):
+            self.entries[path.stem] = path.stat().st_size
+            if path.suffix == ".npk":
+                self.packed.add(path.stem)
+        self.total_bytes = sum(self.entries.values())
+
+    def path(self, key: str, packed: bool = False) -> Path:
+        """Gets the file path for a cache key, stored packed or as float32."""
+        suffix = ".npk" if packed else ".npy"
+        return self.directory / f"{key}{suffix}"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Gets an entry from the cache as a read-only memory-mapped array.
+
+        Args:
+            key: Cache key of the entry.
+
+        Returns: The cached array, or None if it's not in the cache.
+            Packed entries are decoded to a new float32 array.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            packed = key in self.packed
+        path = self.path(key, packed)
+        try:
+            os.utime(path)
+            if packed:
+                return load_packed(path).decode()
+            return np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            # Another process sharing the directory evicted it.
+            with self.lock:
+                self.forget(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put(self, key: str, value: np.ndarray | PackedPatch) -> None:
+        """Adds an entry to the cache, evicting the least recently used ones.
+
+        Args:
+            key: Cache key of the entry.
+            value: Array to store, packed first if the cache has a packing.
+        """
+        if self.packing and not isinstance(value, PackedPatch):
+            value = pack(value, self.packing)
+        packed = isinstance(value, PackedPatch)
+        path = self.path(key, packed)
+
+        # Write to a temporary file first so readers never see partial entries.
+        with tempfile.NamedTemporaryFile(
+            dir=self.directory, suffix=".tmp", delete=False
+        ) as f:
+            if packed:
+                save_packed(f, value)
+            else:
+                np.save(f, value, allow_pickle=False)
+        os.replace(f.name, path)
+
+        with self.lock:
+            if key in self.entries and (key in self.packed) != packed:
+                # Replace the entry stored in the other format.
+                self.path(key, not packed).unlink(missing_ok=True)
+            self.forget(key)
+            self.entries[key] = path.stat().st_size
+            self.total_bytes += self.entries[key]
+            if packed:
+                self.packed.add(key)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest, _ = next(iter(self.entries.items()))
+                oldest_path = self.path(oldest, oldest in self.packed)
+                self.forget(oldest)
+                oldest_path.unlink(missing_ok=True)
+                self.evictions += 1
+
+    def forget(self, key: str) -> None:
+        """Removes an entry from the index, the lock must be held."""
+        self.total_bytes -= self.entries.pop(key, 0)
+        self.packed.discard(key)
+
+    def stats(self) -> dict[str, int]:
+        """Gets the cache counters."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+            }
@@ -15,42 +15,414 @@
 """Data utilities to grab data from Earth Engine.
 Meant to be used for both training and prediction so the model is
 trained on exactly the same data that will be used for predictions.
+
+Patches are fetched through a `PatchSource`. By default that is Earth Engine,
+but setting `WEATHER_TILE_STORE` to a local tile store directory reads
+pre-ingested rasters from disk instead, see `weather.local`.
+
+Earth Engine regions are computed with a single gzip compressed request to
+the computePixels endpoint, on a latitude/longitude grid. Setting
+`WEATHER_COMPUTE_PIXELS=0` goes back to minting a download URL with
+`getDownloadURL` and downloading it in a second round trip.
+
+Patches around a point are still downloaded over the bounds of a buffered
+point, which the model was trained on. Setting `WEATHER_POINT_GRID=1`
+computes them on a latitude/longitude grid too, see `get_point_bounds`.
 """
 
 from __future__ import annotations
 
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import io
+import gzip
+import json
+import math
+import os
+import threading
+from typing import TYPE_CHECKING, Any as AnyType, Callable, Optional
 
-import ee
-from google.api_core import exceptions, retry
-import google.auth
 import numpy as np
-from numpy.lib.recfunctions import structured_to_unstructured
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+
+from weather.cache import PatchCache, cache_key
+from weather.governor import RateGovernor, Throttled
+from weather.metrics import metrics, span
+from weather.npy import read_npy
+from weather.singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    # Importing Earth Engine is slow, so it's only imported when first used.
+    import ee
 
 # Constants.
 SCALE = 10000  # meters per pixel
 INPUT_HOUR_DELTAS = [-4, -2, 0]
 OUTPUT_HOUR_DELTAS = [2, 6]
 WINDOW = timedelta(days=1)
-
-# Authenticate and initialize Earth Engine with the default credentials.
-credentials, project = google.auth.default(
-    scopes=[
-        "https://www.googleapis.com/auth/cloud-platform",
-        "https://www.googleapis.com/auth/earthengine",
-    ]
+MAX_WORKERS = 16  # maximum number of concurrent downloads
+CACHE_DIR = os.environ.get(
+    "WEATHER_CACHE_DIR", os.path.expanduser("~/.cache/weather/patches")
 )
+CACHE_MAX_BYTES = int(os.environ.get("WEATHER_CACHE_MAX_BYTES", 10 * 1024**3))
+FRAME_CACHE_MAX_BYTES = int(os.environ.get("WEATHER_FRAME_CACHE_MAX_BYTES", 1024**3))
+# One of weather.packing.PACKINGS to keep cached patches at half the size.
+CACHE_PACKING = os.environ.get("WEATHER_CACHE_PACKING") or None
+TILE_STORE = os.environ.get("WEATHER_TILE_STORE")  # local tile store directory
+GOES16_BANDS = 16  # number of CMI_C* bands per GOES 16 frame
+INPUT_BANDS = len(INPUT_HOUR_DELTAS) * (1 + GOES16_BANDS) + 1
+LABEL_BANDS = len(OUTPUT_HOUR_DELTAS)
+MAX_RETRY_TIME = float(os.environ.get("WEATHER_MAX_RETRY_TIME", 120))  # seconds
+COMPUTE_PIXELS = os.environ.get("WEATHER_COMPUTE_PIXELS", "1") not in ("", "0")
+POINT_GRID = os.environ.get("WEATHER_POINT_GRID", "0") not in ("", "0")
+METERS_PER_DEGREE = 111320  # at the equator
+# Earth Engine rejects larger requests: 48 MiB for computePixels, and
+# 32 MiB for getDownloadURL, so stay under the lower one.
+MAX_REQUEST_BYTES = 32 * 1024**2
 
-# Use the Earth Engine High Volume endpoint.
+# Earth Engine High Volume endpoint, for both the client library and computePixels.
 #   https://developers.google.com/earth-engine/cloud/highvolume
-ee.Initialize(
-    credentials.with_quota_project(None),
-    project=project,
-    opt_url="https://earthengine-highvolume.googleapis.com",
+HIGH_VOLUME_URL = "https://earthengine-highvolume.googleapis.com"
+
+# Google APIs only compress responses for user agents that ask for gzip.
+COMPRESSED_HEADERS = {"Accept-Encoding": "gzip", "User-Agent": "weather (gzip)"}
+
+# Reuse connections across downloads, with enough pooled connections
+# to keep every download worker busy.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=MAX_WORKERS))
+
+# Bounded pool shared by all the batch download functions.
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="get_patch")
+
+# Downloaded patches are kept on disk since historical imagery never changes,
+# see `get_patch_cache`.
+patch_cache: Optional[PatchCache] = None
+
+# Dropped connections are worth retrying, but unlike "429: Too Many Requests"
+# they don't mean we're over the quota. `ProtocolError` comes from reading the
+# raw response stream, which `requests` doesn't wrap.
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    ProtocolError,
 )
 
+# Every Earth Engine download shares the same adaptive concurrency limit.
+governor = RateGovernor(
+    max_limit=MAX_WORKERS,
+    max_retry_time=MAX_RETRY_TIME,
+    transient_errors=TRANSIENT_ERRORS,
+)
+
+# Identical patches requested at the same time are only downloaded once.
+patch_flights = SingleFlight()
+
+metrics.register(
+    "weather_governor",
+    governor.stats,
+    counters=("requests", "throttles", "errors", "retries", "give_ups"),
+)
+metrics.register(
+    "weather_patch_flights", patch_flights.stats, counters=("calls", "coalesced")
+)
+metrics.register(
+    "weather_patch_cache",
+    lambda: patch_cache.stats() if patch_cache else {},
+    counters=("hits", "misses", "evictions"),
+)
+
+initialize_lock = threading.Lock()
+initialized = False
+
+# Authorized session and computePixels URL of the Cloud project,
+# set by `initialize`.
+compute_session: Optional[requests.Session] = None
+compute_url: Optional[str] = None
+
+
+def initialize() -> None:
+    """Authenticates and initializes Earth Engine with the default credentials.
+
+    This is done on the first fetch rather than at import time,
+    so sources that don't use Earth Engine can run offline.
+    """
+    global initialized, compute_session, compute_url
+    with initialize_lock:
+        if initialized:
+            return
+
+        import ee
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+
+        credentials, project = google.auth.default(
+            scopes=[
+                "https://www.googleapis.com/auth/cloud-platform",
+                "https://www.googleapis.com/auth/earthengine",
+            ]
+        )
+
+        credentials = credentials.with_quota_project(None)
+        ee.Initialize(credentials, project=project, opt_url=HIGH_VOLUME_URL)
+
+        compute_session = AuthorizedSession(credentials)
+        compute_session.mount("https://", HTTPAdapter(pool_maxsize=MAX_WORKERS))
+        compute_url = f"{HIGH_VOLUME_URL}/v1/projects/{project}/image:computePixels"
+        initialized = True
+
+
+def get_patch_cache() -> PatchCache:
+    """Gets the on-disk patch cache, indexing it on first use."""
+    global patch_cache
+    with initialize_lock:
+        if patch_cache is None:
+            patch_cache = PatchCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_PACKING)
+    return patch_cache
+
+
+class PatchSource(ABC):
+    """Where patches of pixels come from.
+
+    Subclasses fetch each dataset independently, and the inputs and labels
+    are assembled from them in the band order the model was trained with.
+    """
+
+    @abstractmethod
+    def get_gpm_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        """Gets the precipitation patch with one band per date."""
+
+    @abstractmethod
+    def get_goes16_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        """Gets the cloud and moisture patch with `GOES16_BANDS` bands per date."""
+
+    @abstractmethod
+    def get_elevation_patch(self, point: tuple, patch_size: int) -> np.ndarray:
+        """Gets the elevation patch with a single band."""
+
+    def get_stacked_patch(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        point: tuple,
+        patch_size: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Gets several datasets stacked as bands of a single patch.
+
+        Subclasses can override this to fetch everything in one request.
+
+        Args:
+            gpm_dates: Dates of the precipitation bands, can be empty.
+            goes16_dates: Dates of the cloud and moisture bands, can be empty.
+            elevation: Whether to add the elevation band at the end.
+            point: A (longitude, latitude) coordinate.
+            patch_size: Size in pixels of the surrounding square patch.
+            out: Optional float32 array to write the patch into.
+
+        Returns: The bands of all the datasets, in that order.
+        """
+        patches = []
+        if gpm_dates:
+            patches.append(self.get_gpm_patch(gpm_dates, point, patch_size))
+        if goes16_dates:
+            patches.append(self.get_goes16_patch(goes16_dates, point, patch_size))
+        if elevation:
+            patches.append(self.get_elevation_patch(point, patch_size))
+        return np.concatenate(patches, axis=-1, out=out)
+
+    def get_stacked_region(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        bounds: tuple[float, float, float, float],
+        shape: tuple[int, int],
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Gets several datasets stacked as bands over a bounding box.
+
+        This is like `get_stacked_patch`, but on a latitude/longitude grid,
+        so patches of neighboring boxes line up with each other.
+
+        Args:
+            gpm_dates: Dates of the precipitation bands, can be empty.
+            goes16_dates: Dates of the cloud and moisture bands, can be empty.
+            elevation: Whether to add the elevation band at the end.
+            bounds: A (west, south, east, north) bounding box in degrees.
+            shape: The (height, width) of the patch in pixels.
+            out: Optional float32 array to write the patch into.
+
+        Returns: The bands of all the datasets, in that order.
+        """
+        raise NotImplementedError(f"{type(self).__name__} doesn't support regions")
+
+    def get_inputs_patch(
+        self,
+        date: datetime,
+        point: tuple,
+        patch_size: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Gets the inputs patch, see `get_inputs_image` for the band order."""
+        dates = [date + timedelta(hours=h) for h in INPUT_HOUR_DELTAS]
+        return self.get_stacked_patch(dates, dates, True, point, patch_size, out)
+
+    def get_labels_patch(
+        self,
+        date: datetime,
+        point: tuple,
+        patch_size: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Gets the labels patch, see `get_labels_image` for the band order."""
+        dates = [date + timedelta(hours=h) for h in OUTPUT_HOUR_DELTAS]
+        return self.get_stacked_patch(dates, [], False, point, patch_size, out)
+
+    def get_inputs_region(
+        self,
+        date: datetime,
+        bounds: tuple[float, float, float, float],
+        shape: tuple[int, int],
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Gets the inputs over a bounding box, see `get_stacked_region`."""
+        dates = [date + timedelta(hours=h) for h in INPUT_HOUR_DELTAS]
+        return self.get_stacked_region(dates, dates, True, bounds, shape, out)
+
+    def get_forecast_patches(
+        self, date: datetime, point: tuple, patch_size: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Gets the inputs and labels patches as a single stacked patch.
+
+        See `get_forecast_dates` for the band order of the stacked patch.
+        """
+        gpm_dates, goes16_dates = get_forecast_dates(date, labels=True)
+        patch = self.get_stacked_patch(gpm_dates, goes16_dates, True, point, patch_size)
+        input_bands, label_bands = get_forecast_bands(labels=True)
+        inputs = np.ascontiguousarray(patch[:, :, input_bands])
+        return (inputs, np.ascontiguousarray(patch[:, :, label_bands]))
+
+
+class EarthEngineSource(PatchSource):
+    """Fetches patches from Earth Engine, each stacked patch in a single request.
+
+    Args:
+        compute_pixels: Whether to fetch with computePixels in a single round
+            trip, or with `getDownloadURL` and a separate download.
+        point_grid: Whether patches around a point are also fetched with
+            computePixels, on the slightly different grid of `get_point_bounds`.
+        cache: Whether patches go through the patch cache on disk. Bulk
+            downloads that never repeat a patch should bypass it.
+    """
+
+    def __init__(
+        self,
+        compute_pixels: bool = COMPUTE_PIXELS,
+        point_grid: bool = POINT_GRID,
+        cache: bool = True,
+    ) -> None:
+        self.compute_pixels = compute_pixels
+        self.point_grid = point_grid
+        self.cache = cache
+
+    def get_gpm_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        return self.get_stacked_patch(dates, [], False, point, patch_size)
+
+    def get_goes16_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        return self.get_stacked_patch([], dates, False, point, patch_size)
+
+    def get_elevation_patch(self, point: tuple, patch_size: int) -> np.ndarray:
+        return self.get_stacked_patch([], [], True, point, patch_size)
+
+    def get_stacked_patch(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        point: tuple,
+        patch_size: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        initialize()
+        image = get_stacked_image(gpm_dates, goes16_dates, elevation)
+        if self.compute_pixels and self.point_grid:
+            bounds = get_point_bounds(point, patch_size, SCALE)
+            shape = (patch_size, patch_size)
+            return get_grid_patch(image, bounds, shape, out, self.cache)
+        return get_patch(image, point, patch_size, SCALE, out, self.cache)
+
+    def get_stacked_region(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        bounds: tuple[float, float, float, float],
+        shape: tuple[int, int],
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        import ee
+
+        initialize()
+        image = get_stacked_image(gpm_dates, goes16_dates, elevation)
+        if self.compute_pixels:
+            return get_grid_patch(image, bounds, shape, out, self.cache)
+        region = ee.Geometry.Rectangle(list(bounds), "EPSG:4326", False)
+        height, width = shape
+        return get_region_patch(image, region, (width, height), out, self.cache)
+
+
+# Source used when none is passed explicitly, see `get_patch_source`.
+patch_source: Optional[PatchSource] = None
+
+
+def get_patch_source() -> PatchSource:
+    """Gets the default patch source.
+
+    This is a local tile store if `WEATHER_TILE_STORE` is set, or Earth Engine
+    otherwise. Earth Engine frames are cached so overlapping forecasts only
+    download the frames they don't share.
+    """
+    global patch_source
+    if patch_source is not None:
+        return patch_source
+    # Concurrent first calls must not create the source, and its metrics, twice.
+    with initialize_lock:
+        if patch_source is None:
+            if TILE_STORE:
+                from weather.local import LocalSource
+
+                patch_source = LocalSource(TILE_STORE)
+            else:
+                from weather.frames import FrameCacheSource
+
+                source = FrameCacheSource(
+                    EarthEngineSource(), FRAME_CACHE_MAX_BYTES, CACHE_PACKING
+                )
+                metrics.register(
+                    "weather_frame_cache", source.stats, counters=("hits", "misses")
+                )
+                patch_source = source
+    return patch_source
+
+
+def set_patch_source(source: PatchSource) -> None:
+    """Sets the default patch source."""
+    global patch_source
+    with initialize_lock:
+        patch_source = source
+
 
 def get_gpm(date: datetime) -> ee.Image:
     """Gets a Global Precipitation Measurement image for the selected date.
@@ -63,6 +435,8 @@ def get_gpm(date: datetime) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    import ee
+
     window_start = (date - WINDOW).isoformat()
     window_end = date.isoformat()
     return (
@@ -84,6 +458,8 @@ def get_gpm_sequence(dates: list[datetime]) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    import ee
+
     images = [get_gpm(date) for date in dates]
     return ee.ImageCollection(images).toBands()
 
@@ -99,6 +475,8 @@ def get_goes16(date: datetime) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    import ee
+
     window_start = (date - WINDOW).isoformat()
     window_end = date.isoformat()
     return (
@@ -120,6 +498,8 @@ def get_goes16_sequence(dates: list[datetime]) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    import ee
+
     images = [get_goes16(date) for date in dates]
     return ee.ImageCollection(images).toBands()
 
@@ -132,6 +512,8 @@ def get_elevation() -> ee.Image:
 
     Returns: An Earth Engine image.
     """
+    import ee
+
     return ee.Image("MERIT/DEM/v1_0_3").rename("elevation").unmask(0).float()
 
 
@@ -143,11 +525,68 @@ def get_inputs_image(date: datetime) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
-    dates = [date + timedelta(hours=h) for h in INPUT_HOUR_DELTAS]
-    precipitation = get_gpm_sequence(dates)
-    cloud_and_moisture = get_goes16_sequence(dates)
-    elevation = get_elevation()
-    return ee.Image([precipitation, cloud_and_moisture, elevation])
+    import ee
+
+    with span("ee_graph"):
+        dates = [date + timedelta(hours=h) for h in INPUT_HOUR_DELTAS]
+        precipitation = get_gpm_sequence(dates)
+        cloud_and_moisture = get_goes16_sequence(dates)
+        elevation = get_elevation()
+        return ee.Image([precipitation, cloud_and_moisture, elevation])
+
+
+def get_forecast_dates(
+    date: datetime, labels: bool
+) -> tuple[list[datetime], list[datetime]]:
+    """Gets the dates to stack the inputs, and optionally the labels, of a forecast.
+
+    The stacked patch has the precipitation at the input dates followed by the
+    label dates, then the cloud and moisture at the input dates, and then the
+    elevation, see `get_forecast_bands` to split it into inputs and labels.
+
+    Args:
+        date: The date of interest.
+        labels: Whether to include the labels.
+
+    Returns: The (gpm_dates, goes16_dates) for `get_stacked_patch`.
+    """
+    input_dates = [date + timedelta(hours=h) for h in INPUT_HOUR_DELTAS]
+    label_dates = [date + timedelta(hours=h) for h in OUTPUT_HOUR_DELTAS]
+    return (input_dates + label_dates if labels else input_dates, input_dates)
+
+
+def get_forecast_bands(labels: bool) -> tuple[list[int], list[int]]:
+    """Gets the (inputs, labels) bands of a patch stacked with `get_forecast_dates`."""
+    num_gpm = len(INPUT_HOUR_DELTAS)
+    goes16_start = num_gpm + LABEL_BANDS if labels else num_gpm
+    elevation_band = goes16_start + num_gpm * GOES16_BANDS
+    inputs = list(range(num_gpm)) + list(range(goes16_start, elevation_band + 1))
+    return (inputs, list(range(num_gpm, goes16_start)))
+
+
+def get_stacked_image(
+    gpm_dates: list[datetime], goes16_dates: list[datetime], elevation: bool
+) -> ee.Image:
+    """Gets an Earth Engine image with several datasets stacked as bands.
+
+    Args:
+        gpm_dates: Dates of the precipitation bands, can be empty.
+        goes16_dates: Dates of the cloud and moisture bands, can be empty.
+        elevation: Whether to add the elevation band at the end.
+
+    Returns: An Earth Engine image.
+    """
+    import ee
+
+    with span("ee_graph"):
+        images = []
+        if gpm_dates:
+            images.append(get_gpm_sequence(gpm_dates))
+        if goes16_dates:
+            images.append(get_goes16_sequence(goes16_dates))
+        if elevation:
+            images.append(get_elevation())
+        return images[0] if len(images) == 1 else ee.Image(images)
 
 
 def get_labels_image(date: datetime) -> ee.Image:
@@ -158,74 +597,463 @@ def get_labels_image(date: datetime) -> ee.Image:
 
     Returns: An Earth Engine image.
     """
-    dates = [date + timedelta(hours=h) for h in OUTPUT_HOUR_DELTAS]
-    return get_gpm_sequence(dates)
+    with span("ee_graph"):
+        dates = [date + timedelta(hours=h) for h in OUTPUT_HOUR_DELTAS]
+        return get_gpm_sequence(dates)
 
 
-def get_inputs_patch(date: datetime, point: tuple, patch_size: int) -> np.ndarray:
+def get_inputs_patch(
+    date: datetime,
+    point: tuple,
+    patch_size: int,
+    source: Optional[PatchSource] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
     """Gets the patch of pixels for the inputs.
 
     Args:
         date: The date of interest.
         point: A (longitude, latitude) coordinate.
         patch_size: Size in pixels of the surrounding square patch.
+        source: Where to get the patch from, defaults to `get_patch_source()`.
+        out: Optional float32 array to write the patch into,
+            like a slot of a preallocated batch.
 
-    Returns: The pixel values of a patch as a NumPy array.
+    Returns: The pixel values of a patch as a float32 NumPy array
+        with shape (patch_size, patch_size, channels).
     """
-    image = get_inputs_image(date)
-    patch = get_patch(image, point, patch_size, SCALE)
-    return structured_to_unstructured(patch)
+    source = source or get_patch_source()
+    return source.get_inputs_patch(date, point, patch_size, out)
 
 
-def get_labels_patch(date: datetime, point: tuple, patch_size: int) -> np.ndarray:
+def get_labels_patch(
+    date: datetime,
+    point: tuple,
+    patch_size: int,
+    source: Optional[PatchSource] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
     """Gets the patch of pixels for the labels.
 
     Args:
         date: The date of interest.
         point: A (longitude, latitude) coordinate.
         patch_size: Size in pixels of the surrounding square patch.
+        source: Where to get the patch from, defaults to `get_patch_source()`.
+        out: Optional float32 array to write the patch into,
+            like a slot of a preallocated batch.
 
-    Returns: The pixel values of a patch as a NumPy array.
+    Returns: The pixel values of a patch as a float32 NumPy array
+        with shape (patch_size, patch_size, channels).
     """
-    image = get_labels_image(date)
-    patch = get_patch(image, point, patch_size, SCALE)
-    return structured_to_unstructured(patch)
+    source = source or get_patch_source()
+    return source.get_labels_patch(date, point, patch_size, out)
 
 
-@retry.Retry()
-def get_patch(image: ee.Image, point: tuple, patch_size: int, scale: int) -> np.ndarray:
-    """Fetches a patch of pixels from Earth Engine.
+def get_inputs_region(
+    date: datetime,
+    bounds: tuple[float, float, float, float],
+    shape: tuple[int, int],
+    source: Optional[PatchSource] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Gets the pixels for the inputs over a bounding box.
+
+    Args:
+        date: The date of interest.
+        bounds: A (west, south, east, north) bounding box in degrees.
+        shape: The (height, width) of the patch in pixels.
+        source: Where to get the patch from, defaults to `get_patch_source()`.
+        out: Optional float32 array to write the patch into.
+
+    Returns: The pixel values as a float32 NumPy array
+        with shape (height, width, channels).
+    """
+    source = source or get_patch_source()
+    return source.get_inputs_region(date, bounds, shape, out)
+
+
+def get_inputs_patches(
+    dates: list[datetime],
+    points: list[tuple],
+    patch_size: int,
+    source: Optional[PatchSource] = None,
+) -> np.ndarray:
+    """Gets the patches of pixels for the inputs of many requests concurrently.
+
+    Args:
+        dates: The dates of interest.
+        points: A (longitude, latitude) coordinate for each date.
+        patch_size: Size in pixels of the surrounding square patches.
+        source: Where to get the patches from, defaults to `get_patch_source()`.
 
-    It retries if we get error "429: Too Many Requests".
+    Returns: The pixel values of all the patches as a NumPy array
+        with shape (len(dates), patch_size, patch_size, channels).
+    """
+    batch = np.empty((len(dates), patch_size, patch_size, INPUT_BANDS), np.float32)
+
+    def fetch(date: datetime, point: tuple, out: np.ndarray) -> np.ndarray:
+        return get_inputs_patch(date, point, patch_size, source, out)
+
+    # Each patch is written directly into its slot of the batch.
+    list(executor.map(fetch, dates, points, batch))
+    return batch
+
+
+def get_labels_patches(
+    dates: list[datetime],
+    points: list[tuple],
+    patch_size: int,
+    source: Optional[PatchSource] = None,
+) -> np.ndarray:
+    """Gets the patches of pixels for the labels of many requests concurrently.
+
+    Args:
+        dates: The dates of interest.
+        points: A (longitude, latitude) coordinate for each date.
+        patch_size: Size in pixels of the surrounding square patches.
+        source: Where to get the patches from, defaults to `get_patch_source()`.
+
+    Returns: The pixel values of all the patches as a NumPy array
+        with shape (len(dates), patch_size, patch_size, channels).
+    """
+    batch = np.empty((len(dates), patch_size, patch_size, LABEL_BANDS), np.float32)
+
+    def fetch(date: datetime, point: tuple, out: np.ndarray) -> np.ndarray:
+        return get_labels_patch(date, point, patch_size, source, out)
+
+    # Each patch is written directly into its slot of the batch.
+    list(executor.map(fetch, dates, points, batch))
+    return batch
+
+
+def get_forecast_patches(
+    date: datetime,
+    point: tuple,
+    patch_size: int,
+    source: Optional[PatchSource] = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Gets the inputs and labels patches for a single forecast in one request.
+
+    Args:
+        date: The date of interest.
+        point: A (longitude, latitude) coordinate.
+        patch_size: Size in pixels of the surrounding square patch.
+        source: Where to get the patches from, defaults to `get_patch_source()`.
+
+    Returns: An (inputs, labels) pair of NumPy arrays.
+    """
+    source = source or get_patch_source()
+    return source.get_forecast_patches(date, point, patch_size)
+
+
+def get_patch(
+    image: ee.Image,
+    point: tuple,
+    patch_size: int,
+    scale: int,
+    out: Optional[np.ndarray] = None,
+    cache: bool = True,
+) -> np.ndarray:
+    """Gets a patch of pixels, from the patch cache if we already downloaded it.
 
     Args:
         image: Image to get the patch from.
         point: A (longitude, latitude) pair for the point of interest.
         patch_size: Size in pixels of the surrounding square patch.
         scale: Number of meters per pixel.
+        out: Optional float32 array to write the patch into.
+        cache: Whether to use the patch cache, or always download the patch.
+
+    Returns:
+        The requested patch of pixels as a float32 NumPy
+        array with shape (width, height, bands).
+    """
+    import ee
+
+    region = ee.Geometry.Point(point).buffer(scale * patch_size / 2, 1).bounds(1)
+    return get_region_patch(image, region, (patch_size, patch_size), out, cache)
+
+
+def get_region_patch(
+    image: ee.Image,
+    region: ee.Geometry,
+    dimensions: tuple[int, int],
+    out: Optional[np.ndarray] = None,
+    cache: bool = True,
+) -> np.ndarray:
+    """Gets the pixels of a region, from the patch cache if we already downloaded it.
+
+    Args:
+        image: Image to get the patch from.
+        region: Bounding box of the patch.
+        dimensions: The (width, height) of the patch in pixels.
+        out: Optional float32 array to write the patch into.
+        cache: Whether to use the patch cache, or always download the patch.
+
+    Returns:
+        The requested patch of pixels as a float32 NumPy
+        array with shape (height, width, bands).
+    """
+    if not cache:
+        return download_patch(image, region, dimensions, out)
+    key = cache_key(
+        image=image.serialize(),
+        region=region.serialize(),
+        dimensions=list(dimensions),
+        format="float32",
+    )
+    return get_cached_patch(key, download_patch, image, region, dimensions, out)
+
+
+def get_grid_patch(
+    image: ee.Image,
+    bounds: tuple[float, float, float, float],
+    shape: tuple[int, int],
+    out: Optional[np.ndarray] = None,
+    cache: bool = True,
+) -> np.ndarray:
+    """Gets the pixels of a bounding box, from the patch cache if we already have them.
+
+    Args:
+        image: Image to get the patch from.
+        bounds: A (west, south, east, north) bounding box in degrees.
+        shape: The (height, width) of the patch in pixels.
+        out: Optional float32 array to write the patch into.
+        cache: Whether to use the patch cache, or always download the patch.
+
+    Returns:
+        The requested patch of pixels as a float32 NumPy
+        array with shape (height, width, bands).
+    """
+    grid = get_grid(bounds, shape)
+    if not cache:
+        return compute_patch(image, grid, out)
+    key = cache_key(image=image.serialize(), grid=grid, format="float32")
+    return get_cached_patch(key, compute_patch, image, grid, out)
+
+
+def get_cached_patch(
+    key: str, download: Callable[..., np.ndarray], *args: AnyType
+) -> np.ndarray:
+    """Gets a patch from the patch cache, or downloads and caches it.
+
+    Args:
+        key: Cache key of the patch.
+        download: Function to download the patch, called with `args`.
+        args: Arguments for `download`, the last one is the `out` array.
+
+    Returns: The patch of pixels as a float32 NumPy array.
+    """
+    out = args[-1]
+    cache = get_patch_cache()
+    patch = cache.get(key)
+    if patch is None:
+        # Concurrent requests for the same patch wait for a single download.
+        patch, coalesced = patch_flights.do(
+            key, download_and_cache, key, download, *args
+        )
+        if not coalesced:
+            return patch
+        # The shared patch may be written into another caller's buffer,
+        # so read our own copy back from the cache, unless it was evicted.
+        patch = cache.get(key)
+        if patch is None:
+            return download(*args)
+
+    if out is None:
+        return patch
+    out[...] = patch
+    return out
+
+
+def download_and_cache(
+    key: str, download: Callable[..., np.ndarray], *args: AnyType
+) -> np.ndarray:
+    """Downloads a patch and adds it to the patch cache, see `get_cached_patch`."""
+    patch = download(*args)
+    get_patch_cache().put(key, patch)
+    return patch
+
+
+def get_point_bounds(
+    point: tuple, patch_size: int, scale: int
+) -> tuple[float, float, float, float]:
+    """Gets the bounding box in degrees of a square patch centered at a point.
+
+    Longitudes are widened by the latitude of the point, so pixels are
+    roughly `scale` meters wide. This is close to, but not the same as, the
+    bounds of the buffered point of `get_patch`, which is a geodesic circle:
+    for 128 pixel patches, this box is 0.1% shorter, and 0.3% narrower at
+    45 degrees of latitude, up to 0.6% at 60 degrees.
+    """
+    lon, lat = point
+    dy = scale * patch_size / 2 / METERS_PER_DEGREE
+    dx = dy / math.cos(math.radians(lat))
+    return (lon - dx, lat - dy, lon + dx, lat + dy)
+
+
+def get_grid(
+    bounds: tuple[float, float, float, float], shape: tuple[int, int]
+) -> dict[str, AnyType]:
+    """Gets the computePixels grid of a bounding box.
+
+    Args:
+        bounds: A (west, south, east, north) bounding box in degrees.
+        shape: The (height, width) of the grid in pixels.
+
+    Returns: A PixelGrid as a JSON serializable dict.
+    """
+    west, south, east, north = bounds
+    height, width = shape
+    return {
+        "dimensions": {"width": width, "height": height},
+        "affineTransform": {
+            "scaleX": (east - west) / width,
+            "shearX": 0,
+            "translateX": west,
+            "shearY": 0,
+            "scaleY": -(north - south) / height,
+            "translateY": north,
+        },
+        "crsCode": "EPSG:4326",
+    }
+
+
+def download_patch(
+    image: ee.Image,
+    region: ee.Geometry,
+    dimensions: tuple[int, int],
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Fetches a patch of pixels from Earth Engine.
+
+    Requests go through the shared `governor`, which limits how many are in
+    flight and retries them if we get error "429: Too Many Requests",
+    or if the connection drops, see `TRANSIENT_ERRORS`.
+    The response is decoded while it streams in, see `read_npy`.
+
+    Args:
+        image: Image to get the patch from.
+        region: Bounding box of the patch.
+        dimensions: The (width, height) of the patch in pixels.
+        out: Optional float32 array to write the patch into.
+
+    Raises:
+        Throttled: If it was still throttled after `MAX_RETRY_TIME`.
+        requests.exceptions.RequestException
+
+    Returns:
+        The requested patch of pixels as a float32 NumPy
+        array with shape (width, height, bands).
+    """
+    return governor.call(fetch_patch, image, region, dimensions, out)
+
+
+def compute_patch(
+    image: ee.Image, grid: dict[str, AnyType], out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Computes a patch of pixels with Earth Engine in a single round trip.
+
+    Like `download_patch`, requests go through the shared `governor`.
+
+    Args:
+        image: Image to compute the patch from.
+        grid: Pixel grid of the patch, see `get_grid`.
+        out: Optional float32 array to write the patch into.
 
     Raises:
+        Throttled: If it was still throttled after `MAX_RETRY_TIME`.
         requests.exceptions.RequestException
 
     Returns:
-        The requested patch of pixels as a structured
-        NumPy array with shape (width, height).
-    """
-    geometry = ee.Geometry.Point(point)
-    url = image.getDownloadURL(
-        {
-            "region": geometry.buffer(scale * patch_size / 2, 1).bounds(1),
-            "dimensions": [patch_size, patch_size],
-            "format": "NPY",
+        The requested patch of pixels as a float32 NumPy
+        array with shape (height, width, bands).
+    """
+    return governor.call(fetch_pixels, image, grid, out)
+
+
+def fetch_pixels(
+    image: ee.Image, grid: dict[str, AnyType], out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Computes a patch of pixels with Earth Engine in a single attempt.
+
+    The image expression and the grid go in the request itself, so there's no
+    separate call to mint a download URL, and the NPY response is compressed.
+
+    Raises:
+        Throttled
+        requests.exceptions.RequestException
+
+    Returns: See `compute_patch`.
+    """
+    with span("ee_serialize"):
+        # Images serialize to their expression as JSON, like in the cache keys.
+        body = {
+            "expression": json.loads(image.serialize(for_cloud_api=True)),
+            "fileFormat": "NPY",
+            "grid": grid,
         }
-    )
+    with span("http_request"):
+        response = compute_session.post(
+            compute_url, json=body, headers=COMPRESSED_HEADERS, stream=True
+        )
+    return read_response(response, out)
+
+
+def fetch_patch(
+    image: ee.Image,
+    region: ee.Geometry,
+    dimensions: tuple[int, int],
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Fetches a patch of pixels from Earth Engine in a single attempt.
+
+    Raises:
+        Throttled
+        requests.exceptions.RequestException
+
+    Returns: See `download_patch`.
+    """
+    with span("get_download_url"):
+        url = image.getDownloadURL(
+            {
+                "region": region,
+                "dimensions": list(dimensions),
+                "format": "NPY",
+            }
+        )
+
+    with span("http_request"):
+        response = session.get(url, stream=True)
+    return read_response(response, out)
+
+
+def read_response(
+    response: requests.Response, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Decodes an NPY response while it streams in.
 
+    Raises:
+        Throttled
+        requests.exceptions.RequestException
+
+    Returns: The patch of pixels as a float32 NumPy array.
+    """
     # If we get "429: Too Many Requests" errors, it's safe to retry the request.
-    # The Retry library only works with `google.api_core` exceptions.
-    response = requests.get(url)
-    if response.status_code == 429:
-        raise exceptions.TooManyRequests(response.text)
-
-    # Still raise any other exceptions to make sure we got valid data.
-    response.raise_for_status()
-    return np.load(io.BytesIO(response.content), allow_pickle=True)
+    with response:
+        if response.status_code == 429:
+            raise Throttled(response.text)
+
+        # Still raise any other exceptions to make sure we got valid data.
+        response.raise_for_status()
+
+        # Decompress gzip ourselves: with small reads, urllib3 1.x can return
+        # nothing before the end of a compressed stream, which looks like EOF.
+        stream = response.raw
+        if response.headers.get("Content-Encoding") == "gzip":
+            stream = gzip.GzipFile(fileobj=response.raw)
+        else:
+            response.raw.decode_content = True
+        with span("npy_decode", bytes=response.headers.get("Content-Length")):
+            return read_npy(stream, out)
@@ -0,0 +1,176 @@
+"""Ensembles of WeatherModels evaluated in a single forward pass.
+
+Models with the same architecture can be stacked into a single network: the
+first convolutions of every member see the same inputs, so their filters are
+simply concatenated, and the following layers become grouped convolutions
+where each group only sees the channels of its own member. This runs the
+whole ensemble as one batched pass instead of one forward pass per member.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any as AnyType, Optional
+
+import numpy as np
+import torch
+
+from weather.inference import InferenceEngine
+from weather.model import WeatherModel
+from weather.optimize import (
+    FusedWeatherNet,
+    check_equivalence,
+    optimize_for_inference,
+)
+from weather.registry import load_pretrained
+
+
+@dataclass
+class EnsembleForecast:
+    """Predictions of every member of an ensemble, with their summary."""
+
+    members: np.ndarray  # (members, height, width, outputs)
+    mean: np.ndarray  # (height, width, outputs)
+    spread: np.ndarray  # (height, width, outputs), standard deviation
+
+    @staticmethod
+    def from_members(members: np.ndarray) -> EnsembleForecast:
+        """Summarizes the predictions of every member."""
+        return EnsembleForecast(members, members.mean(axis=0), members.std(axis=0))
+
+
+class EnsembleNet(torch.nn.Module):
+    """Several optimized WeatherModels stacked into a single network.
+
+    The predictions have shape (batch, members, height, width, outputs).
+
+    Args:
+        members: Optimized models with the same architecture.
+    """
+
+    def __init__(self, members: list[FusedWeatherNet]) -> None:
+        super().__init__()
+        first = members[0]
+        for member in members[1:]:
+            if get_architecture(member) != get_architecture(first):
+                raise ValueError("Ensemble members must have the same architecture")
+
+        self.config = first.config
+        self.num_members = len(members)
+        self.num_outputs = first.head.out_channels
+        with torch.no_grad():
+            self.conv = stack(
+                [m.conv for m in members],
+                torch.nn.Conv2d(
+                    first.conv.in_channels,
+                    first.conv.out_channels * len(members),
+                    first.conv.kernel_size,
+                ),
+            )
+            self.conv_transpose = stack(
+                [m.conv_transpose for m in members],
+                torch.nn.ConvTranspose2d(
+                    first.conv_transpose.in_channels * len(members),
+                    first.conv_transpose.out_channels * len(members),
+                    first.conv_transpose.kernel_size,
+                    groups=len(members),
+                ),
+            )
+            self.head = stack(
+                [m.head for m in members],
+                torch.nn.Conv2d(
+                    first.head.in_channels * len(members),
+                    first.head.out_channels * len(members),
+                    1,
+                    groups=len(members),
+                ),
+            )
+        self.to(memory_format=torch.channels_last)
+
+    def forward(
+        self, inputs: torch.Tensor, labels: Optional[torch.Tensor] = None
+    ) -> dict[str, torch.Tensor]:
+        x = inputs.permute(0, 3, 1, 2)  # channels-last view, no copies
+        x = torch.relu(self.conv(x))
+        x = torch.relu(self.conv_transpose(x))
+        x = torch.relu(self.head(x))  # precipitation cannot be negative
+        x = x.unflatten(1, (self.num_members, self.num_outputs))
+        return {"logits": x.permute(0, 1, 3, 4, 2)}
+
+
+class EnsembleMember(torch.nn.Module):
+    """Selects the predictions of a single member of an ensemble."""
+
+    def __init__(self, ensemble: EnsembleNet, index: int, config: AnyType) -> None:
+        super().__init__()
+        self.ensemble = ensemble
+        self.index = index
+        self.config = config
+
+    def forward(self, inputs: torch.Tensor) -> dict[str, torch.Tensor]:
+        return {"logits": self.ensemble(inputs)["logits"][:, self.index]}
+
+
+def get_architecture(model: FusedWeatherNet) -> list[tuple[int, ...]]:
+    """Gets the shapes of all the parameters of a model."""
+    return [tuple(parameter.shape) for parameter in model.parameters()]
+
+
+def stack(layers: list[torch.nn.Module], stacked: torch.nn.Module) -> torch.nn.Module:
+    """Copies the weights and biases of several layers into a stacked layer.
+
+    Both Conv2d and grouped ConvTranspose2d weights are stacked along their
+    first dimension, which holds the output and input channels respectively.
+    """
+    stacked.weight.copy_(torch.cat([layer.weight for layer in layers]))
+    stacked.bias.copy_(torch.cat([layer.bias for layer in layers]))
+    return stacked
+
+
+def build_ensemble(models: list[WeatherModel], check: bool = True) -> EnsembleNet:
+    """Stacks several WeatherModels into a single network.
+
+    Args:
+        models: Models with the same architecture.
+        check: Whether to verify each member against its original model.
+
+    Raises:
+        ValueError: If the models have different architectures,
+            or the ensemble doesn't match the original models.
+
+    Returns: The ensemble network.
+    """
+    models = [model.to("cpu") for model in models]
+    members = [optimize_for_inference(model, check=False) for model in models]
+    ensemble = EnsembleNet(members).eval()
+    if check:
+        for i, model in enumerate(models):
+            check_equivalence(model, EnsembleMember(ensemble, i, model.config))
+    return ensemble
+
+
+def load_ensemble(
+    model_dirs: list[str | Path],
+    num_threads: Optional[int] = None,
+    num_workers: Optional[int] = None,
+) -> AnyType:
+    """Loads several pretrained models as a single ensemble engine.
+
+    The engine predicts with shape (members, height, width, outputs) for a
+    single request, see `EnsembleForecast.from_members` to summarize them.
+
+    Args:
+        model_dirs: Paths to pretrained model directories.
+        num_threads: Number of intra-op threads for CPU inference.
+        num_workers: Number of worker processes sharing the ensemble,
+            see `weather.pool`. The threads are split between them.
+
+    Returns: An inference engine for the ensemble.
+    """
+    models = [load_pretrained(model_dir) for model_dir in model_dirs]
+    if num_workers:
+        from weather.pool import ProcessPoolEngine
+
+        return ProcessPoolEngine(build_ensemble(models), num_workers, num_threads)
+    return InferenceEngine(build_ensemble(models), num_threads=num_threads)
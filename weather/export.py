@@ -0,0 +1,87 @@
+"""Exports models to TorchScript and ONNX for the alternate runtime backends.
+
+To export one or more model directories:
+
+    python -m weather.export models/26_100_epochs_tropics models/26_100_epochs_americas
+
+This writes the TorchScript and ONNX graphs of the optimized model, see
+`weather.optimize`, next to the pretrained weights. Both graphs take inputs
+with dynamic batch, height and width axes.
+"""
+
+from __future__ import annotations
+
+import argparse
+import inspect
+from pathlib import Path
+
+import torch
+
+from weather.model import WeatherModel
+from weather.optimize import optimize_for_inference
+from weather.runtime import ONNX_FILENAME, TORCHSCRIPT_FILENAME
+
+
+class LogitsOnly(torch.nn.Module):
+    """Unwraps the predictions from the outputs dict, for exporting."""
+
+    def __init__(self, model: torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        return self.model(inputs)["logits"]
+
+
+def export_model(model_dir: str | Path, patch_size: int = 128) -> None:
+    """Exports a pretrained model to TorchScript and ONNX.
+
+    Args:
+        model_dir: Path to a pretrained model directory.
+        patch_size: Size in pixels of the example patch used for tracing.
+    """
+    model_dir = Path(model_dir)
+    model = WeatherModel.from_pretrained(model_dir).to("cpu")
+    graph = LogitsOnly(optimize_for_inference(model)).eval()
+    example = torch.zeros((1, patch_size, patch_size, model.config.num_inputs))
+
+    with torch.no_grad():
+        traced = torch.jit.trace(graph, example)
+    config = model.config.to_json_string()
+    torch.jit.save(
+        traced,
+        str(model_dir / TORCHSCRIPT_FILENAME),
+        _extra_files={"config.json": config},
+    )
+
+    # Newer versions of torch default to the dynamo exporter, which needs
+    # onnxscript, older ones only have the TorchScript exporter.
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+    axes = {0: "batch", 1: "height", 2: "width"}
+    torch.onnx.export(
+        graph,
+        example,
+        str(model_dir / ONNX_FILENAME),
+        input_names=["inputs"],
+        output_names=["logits"],
+        dynamic_axes={"inputs": axes, "logits": axes},
+        opset_version=17,
+        **options,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model_dirs", nargs="+", help="Pretrained model directories.")
+    parser.add_argument("--patch-size", type=int, default=128)
+    args = parser.parse_args()
+
+    for model_dir in args.model_dirs:
+        export_model(model_dir, args.patch_size)
+        print(f"Exported {model_dir}")
+
+
+if __name__ == "__main__":
+    main()
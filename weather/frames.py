@@ -0,0 +1,140 @@
+"""In-memory cache of single-timestamp frames.
+
+Forecasts close in time share most of their frames: a forecast at T and one at
+T+2h share two of their three input frames, and the labels at T become inputs
+later on. Caching each frame on its own lets any patch be assembled from the
+frames we already have, and only the missing ones are fetched.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from datetime import datetime
+import threading
+from typing import Optional
+
+import numpy as np
+
+from weather.data import GOES16_BANDS, PatchSource
+from weather.packing import PackedPatch, pack
+
+
+class FrameCacheSource(PatchSource):
+    """Wraps a patch source with a least recently used cache of frames.
+
+    Frames are keyed by dataset, timestamp, point and patch size.
+    The static elevation frame is only fetched once per location.
+
+    Args:
+        source: Patch source to fetch the missing frames from.
+        max_bytes: Maximum total size of the cached frames.
+        packing: Optional packing to keep the frames in, see `weather.packing`.
+    """
+
+    def __init__(
+        self, source: PatchSource, max_bytes: int, packing: Optional[str] = None
+    ) -> None:
+        self.source = source
+        self.max_bytes = max_bytes
+        self.packing = packing
+        self.frames: OrderedDict[tuple, np.ndarray | PackedPatch] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_gpm_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        return self.get_stacked_patch(dates, [], False, point, patch_size)
+
+    def get_goes16_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        return self.get_stacked_patch([], dates, False, point, patch_size)
+
+    def get_elevation_patch(self, point: tuple, patch_size: int) -> np.ndarray:
+        return self.get_stacked_patch([], [], True, point, patch_size)
+
+    def get_stacked_patch(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        point: tuple,
+        patch_size: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        point = tuple(point)
+        keys = [("gpm", date, point, patch_size) for date in gpm_dates]
+        keys += [("goes16", date, point, patch_size) for date in goes16_dates]
+        if elevation:
+            keys.append(("elevation", None, point, patch_size))
+
+        frames = {key: self.get(key) for key in keys}
+        missing = [key for key in keys if frames[key] is None]
+        if missing:
+            # Fetch all the missing frames at once, in the same band order.
+            patch = self.source.get_stacked_patch(
+                [date for (dataset, date, _, _) in missing if dataset == "gpm"],
+                [date for (dataset, date, _, _) in missing if dataset == "goes16"],
+                elevation and frames[keys[-1]] is None,
+                point,
+                patch_size,
+            )
+            start = 0
+            for key in missing:
+                bands = GOES16_BANDS if key[0] == "goes16" else 1
+                frames[key] = patch[:, :, start : start + bands].copy()
+                start += bands
+                self.put(key, frames[key])
+
+        return np.concatenate([frames[key] for key in keys], axis=-1, out=out)
+
+    def get_stacked_region(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        bounds: tuple[float, float, float, float],
+        shape: tuple[int, int],
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        # Regions rarely repeat exactly, so they're not cached.
+        return self.source.get_stacked_region(
+            gpm_dates, goes16_dates, elevation, bounds, shape, out
+        )
+
+    def get(self, key: tuple) -> Optional[np.ndarray]:
+        """Gets a frame from the cache, or None if it's not cached."""
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(key)
+            self.hits += 1
+        return frame.decode() if isinstance(frame, PackedPatch) else frame
+
+    def put(self, key: tuple, frame: np.ndarray) -> None:
+        """Adds a frame to the cache, evicting the least recently used ones."""
+        if self.packing:
+            frame = pack(frame, self.packing)
+        with self.lock:
+            if key in self.frames:
+                self.total_bytes -= self.frames.pop(key).nbytes
+            self.frames[key] = frame
+            self.total_bytes += frame.nbytes
+            while self.total_bytes > self.max_bytes and len(self.frames) > 1:
+                _, oldest = self.frames.popitem(last=False)
+                self.total_bytes -= oldest.nbytes
+
+    def stats(self) -> dict[str, int]:
+        """Gets the cache counters."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "frames": len(self.frames),
+                "bytes": self.total_bytes,
+            }
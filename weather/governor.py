@@ -0,0 +1,183 @@
+"""Shared limit on concurrent Earth Engine requests, adjusted to the quota.
+
+Retrying every throttled request on its own makes all the download workers
+back off and come back together, alternating between idle and throttled.
+Instead, every request goes through a single governor that limits how many
+are in flight at once, and adjusts that limit like TCP congestion control:
+
+    - Additive increase: every successful round of requests raises the limit
+      by one, slowly probing for more quota.
+    - Multiplicative decrease: a "429: Too Many Requests" halves the limit,
+      at most once per round trip, and the request is retried with backoff.
+
+Transient errors, like dropped connections, are also retried with backoff,
+but they say nothing about the quota so they leave the limit alone.
+
+Requests slower than the target latency also stop the limit from growing,
+since queueing on the server means we're already at its capacity. Retries
+give up once a request has been retrying for longer than `max_retry_time`.
+"""
+
+from __future__ import annotations
+
+import random
+import threading
+import time
+from typing import Any as AnyType, Callable, Optional
+
+from weather.metrics import span
+
+
+class Throttled(Exception):
+    """The server answered "429: Too Many Requests", it's safe to retry."""
+
+
+class RateGovernor:
+    """Limits concurrent requests with additive increase, multiplicative decrease.
+
+    Args:
+        max_limit: Maximum number of requests in flight.
+        min_limit: Minimum number of requests in flight.
+        initial_limit: Starting limit, defaults to `max_limit`.
+        decrease: Factor to multiply the limit by when throttled.
+        target_latency: Seconds above which a request counts as congested.
+        max_retry_time: Seconds after which a retried request gives up.
+        initial_backoff: Seconds to wait before the first retry.
+        max_backoff: Maximum seconds to wait between retries.
+        transient_errors: Errors retried with backoff without lowering the limit.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial_limit: Optional[int] = None,
+        decrease: float = 0.5,
+        target_latency: Optional[float] = None,
+        max_retry_time: float = 120.0,
+        initial_backoff: float = 0.25,
+        max_backoff: float = 30.0,
+        transient_errors: tuple[type[BaseException], ...] = (),
+    ) -> None:
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(initial_limit or max_limit)
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_retry_time = max_retry_time
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.transient_errors = transient_errors
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.throttles = 0
+        self.errors = 0
+        self.retries = 0
+        self.give_ups = 0
+        self.latency = 0.0  # moving average of successful requests, in seconds
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """Waits until there's room for another request in flight."""
+        with self.condition:
+            self.waiting += 1
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+            self.requests += 1
+
+    def release(self, throttled: bool, latency: float) -> None:
+        """Adjusts the limit with the outcome of a request that finished.
+
+        Args:
+            throttled: Whether the request was throttled.
+            latency: Seconds the request took.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttles += 1
+                # Requests in flight together see the same congestion,
+                # so only decrease once per round trip.
+                if now - self.last_decrease > self.latency:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                if self.latency:
+                    self.latency = 0.9 * self.latency + 0.1 * latency
+                else:
+                    self.latency = latency
+                if self.target_latency is None or latency <= self.target_latency:
+                    # About one more request per round of `limit` requests.
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def call(self, fn: Callable[..., AnyType], *args: AnyType) -> AnyType:
+        """Calls a function within the limit, retrying while it's throttled.
+
+        Transient errors are retried the same way, but only `Throttled`
+        lowers the limit.
+
+        Args:
+            fn: Function making a request, raising `Throttled` on 429 errors.
+            args: Arguments to call the function with.
+
+        Raises:
+            Throttled: If it was still throttled after `max_retry_time`.
+            BaseException: Any other error, or a transient error that kept
+                happening after `max_retry_time`.
+
+        Returns: The result of the function.
+        """
+        deadline = time.monotonic() + self.max_retry_time
+        backoff = self.initial_backoff
+        while True:
+            with span("governor_wait"):
+                self.acquire()
+            start = time.monotonic()
+            try:
+                result = fn(*args)
+            except BaseException as error:
+                if isinstance(error, Throttled):
+                    self.release(True, time.monotonic() - start)
+                else:
+                    # Other errors say nothing about the quota.
+                    with self.condition:
+                        self.in_flight -= 1
+                        self.condition.notify_all()
+                    if not isinstance(error, self.transient_errors):
+                        raise
+                    with self.condition:
+                        self.errors += 1
+                delay = backoff * random.uniform(0.5, 1.0)  # jitter the retries
+                if time.monotonic() + delay > deadline:
+                    with self.condition:
+                        self.give_ups += 1
+                    raise
+                with self.condition:
+                    self.retries += 1
+                time.sleep(delay)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self.release(False, time.monotonic() - start)
+            return result
+
+    def stats(self) -> dict[str, AnyType]:
+        """Gets the current limit and counters to monitor throttling."""
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "requests": self.requests,
+                "throttles": self.throttles,
+                "errors": self.errors,
+                "retries": self.retries,
+                "give_ups": self.give_ups,
+                "latency": self.latency,
+            }
@@ -0,0 +1,105 @@
+"""Inference engine to serve predictions from a WeatherModel.
+
+Choosing the device, moving the model and setting up the execution mode is
+done once when the engine is created rather than on every request, so each
+prediction only pays for the forward pass itself.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Any as AnyType, Optional
+
+import numpy as np
+import torch
+
+from weather.metrics import span
+
+
+class InferenceEngine:
+    """Runs a model in inference mode on a pinned device.
+
+    Args:
+        model: Model to run, its forward must return {"logits": predictions}.
+        device: Device to run on, defaults to CUDA if available or CPU otherwise.
+        num_threads: Number of intra-op threads for CPU inference,
+            this is process-wide so it should be the same for every engine.
+        batch_sizes: Batch sizes to preallocate input buffers for.
+        patch_size: Size in pixels of the patches to preallocate buffers for.
+        warmup: Whether to run a forward pass for each batch size on creation.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        device: Optional[str] = None,
+        num_threads: Optional[int] = None,
+        batch_sizes: tuple[int, ...] = (1,),
+        patch_size: int = 128,
+        warmup: bool = True,
+    ) -> None:
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.device = torch.device(
+            device or ("cuda" if torch.cuda.is_available() else "cpu")
+        )
+        self.model = model.to(self.device).eval()
+        self.num_inputs = model.config.num_inputs
+        self.lock = threading.Lock()
+
+        # Reusable input buffers for common batch shapes. Inputs are staged in
+        # host memory, which is pinned for faster transfers to a GPU.
+        self.buffers: dict[tuple, tuple[torch.Tensor, torch.Tensor]] = {}
+        for n in batch_sizes:
+            shape = (n, patch_size, patch_size, self.num_inputs)
+            if self.device.type == "cpu":
+                host = torch.zeros(shape)
+                self.buffers[shape] = (host, host)
+            else:
+                host = torch.zeros(shape, pin_memory=True)
+                self.buffers[shape] = (host, torch.zeros(shape, device=self.device))
+        if warmup:
+            for _, inputs in self.buffers.values():
+                with torch.inference_mode():
+                    self.model(inputs)
+
+    def predict(self, inputs: AnyType) -> np.ndarray:
+        """Predicts a single request."""
+        return self.predict_batch(np.asarray(inputs, np.float32)[None])[0]
+
+    def predict_batch(self, inputs_batch: AnyType) -> np.ndarray:
+        """Predicts a batch of requests.
+
+        Args:
+            inputs_batch: Inputs with shape (batch, height, width, channels).
+
+        Returns: The predictions with shape (batch, height, width, outputs).
+        """
+        array = np.asarray(inputs_batch, np.float32)
+        with self.lock, torch.inference_mode():
+            with span("copy_inputs"):
+                inputs = self.as_tensor(array)
+            # The normalization is part of the forward pass, see `weather.optimize`.
+            with span("forward", batch_size=len(array)):
+                return self.model(inputs)["logits"].cpu().numpy()
+
+    def as_tensor(self, array: np.ndarray) -> torch.Tensor:
+        """Gets an input tensor on the device, avoiding copies when possible.
+
+        Writable, contiguous arrays are used as-is on CPU. Anything else is
+        copied into a preallocated buffer if there's one for its shape.
+        """
+        if (
+            self.device.type == "cpu"
+            and array.flags.c_contiguous
+            and array.flags.writeable
+        ):
+            return torch.from_numpy(array)
+
+        if array.shape not in self.buffers:
+            return torch.tensor(array, device=self.device)
+        host, inputs = self.buffers[array.shape]
+        host.numpy()[...] = array
+        if inputs is not host:
+            inputs.copy_(host, non_blocking=True)
+        return inputs
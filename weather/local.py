@@ -0,0 +1,181 @@
+"""Local tile store to get patches without network access.
+
+The tile store is a directory of pre-ingested rasters that share a single
+latitude/longitude grid, stored as NPY mosaics that are memory-mapped on read,
+so cropping a patch only touches the pages within the patch window.
+
+    <root>/
+        grid.json                   {"west": ., "north": ., "dx": ., "dy": .}
+        elevation.npy               (height, width, 1) MERIT elevation
+        gpm/<YYYYMMDDTHHMM>.npy     (height, width, 1) GPM precipitation
+        goes16/<YYYYMMDDTHHMM>.npy  (height, width, 16) GOES 16 CMI bands
+
+The grid origin is the north-west corner of the top-left pixel, and `dx`/`dy`
+are the pixel sizes in degrees. To match Earth Engine patches, rasters should
+be ingested at roughly `SCALE` meters per pixel.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from datetime import datetime
+import json
+from pathlib import Path
+import threading
+from typing import Optional
+
+import numpy as np
+
+from weather.data import GOES16_BANDS, WINDOW, PatchSource
+
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M"
+
+
+class LocalSource(PatchSource):
+    """Reads patches from a local tile store.
+
+    Like the Earth Engine source, each frame is the oldest one within `WINDOW`
+    before the requested date, and missing data is filled with zeros.
+
+    Args:
+        root: Directory of the tile store.
+    """
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+        with open(self.root / "grid.json") as f:
+            self.grid = json.load(f)
+        self.timestamps = {
+            "gpm": self.list_timestamps("gpm"),
+            "goes16": self.list_timestamps("goes16"),
+        }
+        self.arrays: dict[Path, np.ndarray] = {}
+        self.lock = threading.Lock()
+
+    def get_gpm_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        patches = [self.get_frame("gpm", 1, date, point, patch_size) for date in dates]
+        return np.concatenate(patches, axis=-1)
+
+    def get_goes16_patch(
+        self, dates: list[datetime], point: tuple, patch_size: int
+    ) -> np.ndarray:
+        patches = [
+            self.get_frame("goes16", GOES16_BANDS, date, point, patch_size)
+            for date in dates
+        ]
+        return np.concatenate(patches, axis=-1)
+
+    def get_elevation_patch(self, point: tuple, patch_size: int) -> np.ndarray:
+        return self.crop(self.root / "elevation.npy", 1, point, patch_size)
+
+    def get_stacked_region(
+        self,
+        gpm_dates: list[datetime],
+        goes16_dates: list[datetime],
+        elevation: bool,
+        bounds: tuple[float, float, float, float],
+        shape: tuple[int, int],
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        paths = [(self.find_frame("gpm", date), 1) for date in gpm_dates]
+        paths += [(self.find_frame("goes16", d), GOES16_BANDS) for d in goes16_dates]
+        if elevation:
+            paths.append((self.root / "elevation.npy", 1))
+        patches = [self.resample(path, bands, bounds, shape) for path, bands in paths]
+        return np.concatenate(patches, axis=-1, out=out)
+
+    def get_frame(
+        self, dataset: str, bands: int, date: datetime, point: tuple, patch_size: int
+    ) -> np.ndarray:
+        """Crops the oldest frame of a dataset within the window."""
+        path = self.find_frame(dataset, date)
+        if path is None:
+            return np.zeros((patch_size, patch_size, bands), np.float32)
+        return self.crop(path, bands, point, patch_size)
+
+    def find_frame(self, dataset: str, date: datetime) -> Optional[Path]:
+        """Finds the oldest frame of a dataset within the window, if any.
+
+        Earth Engine sorts the frames from newest to oldest before making a
+        mosaic, which draws the last one on top, so the oldest frame wins.
+        """
+        timestamps = self.timestamps[dataset]
+        i = bisect_left(timestamps, date - WINDOW)
+        if i == len(timestamps) or timestamps[i] >= date:
+            return None
+        filename = f"{timestamps[i].strftime(TIMESTAMP_FORMAT)}.npy"
+        return self.root / dataset / filename
+
+    def crop(self, path: Path, bands: int, point: tuple, patch_size: int) -> np.ndarray:
+        """Crops a square window centered at a point, padding with zeros."""
+        array = self.open(path)
+        lon, lat = point
+        col = round((lon - self.grid["west"]) / self.grid["dx"]) - patch_size // 2
+        row = round((self.grid["north"] - lat) / self.grid["dy"]) - patch_size // 2
+
+        patch = np.zeros((patch_size, patch_size, bands), np.float32)
+        height, width = array.shape[:2]
+        top, bottom = max(row, 0), min(row + patch_size, height)
+        left, right = max(col, 0), min(col + patch_size, width)
+        if top < bottom and left < right:
+            window = array[top:bottom, left:right].reshape(
+                bottom - top, right - left, bands
+            )
+            patch[top - row : bottom - row, left - col : right - col] = window
+        return patch
+
+    def resample(
+        self,
+        path: Optional[Path],
+        bands: int,
+        bounds: tuple[float, float, float, float],
+        shape: tuple[int, int],
+    ) -> np.ndarray:
+        """Samples a bounding box with the nearest pixels, padding with zeros."""
+        height, width = shape
+        patch = np.zeros((height, width, bands), np.float32)
+        if path is None:
+            return patch
+
+        # Find the grid pixel under the center of each output pixel.
+        array = self.open(path)
+        west, south, east, north = bounds
+        lons = west + (np.arange(width) + 0.5) * (east - west) / width
+        lats = north - (np.arange(height) + 0.5) * (north - south) / height
+        cols = np.floor((lons - self.grid["west"]) / self.grid["dx"]).astype(int)
+        rows = np.floor((self.grid["north"] - lats) / self.grid["dy"]).astype(int)
+        valid_cols = (cols >= 0) & (cols < array.shape[1])
+        valid_rows = (rows >= 0) & (rows < array.shape[0])
+
+        window = array[np.ix_(rows[valid_rows], cols[valid_cols])]
+        patch[np.ix_(valid_rows, valid_cols)] = window.reshape(*window.shape[:2], bands)
+        return patch
+
+    def open(self, path: Path) -> np.ndarray:
+        """Opens a raster as a memory-mapped array, reusing open rasters."""
+        with self.lock:
+            if path not in self.arrays:
+                self.arrays[path] = np.load(path, mmap_mode="r")
+            return self.arrays[path]
+
+    def list_timestamps(self, dataset: str) -> list[datetime]:
+        """Lists the timestamps of all the frames of a dataset, sorted."""
+        paths = (self.root / dataset).glob("*.npy")
+        return sorted(datetime.strptime(p.stem, TIMESTAMP_FORMAT) for p in paths)
+
+    def save_frame(self, dataset: str, date: datetime, raster: np.ndarray) -> None:
+        """Ingests a frame into the tile store.
+
+        Args:
+            dataset: Either "gpm" or "goes16".
+            date: Timestamp of the frame.
+            raster: Frame covering the whole grid, with shape (height, width, bands).
+        """
+        path = self.root / dataset / f"{date.strftime(TIMESTAMP_FORMAT)}.npy"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(path, np.asarray(raster, np.float32), allow_pickle=False)
+        with self.lock:
+            self.arrays.pop(path, None)
+            self.timestamps[dataset] = self.list_timestamps(dataset)
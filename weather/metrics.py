@@ -0,0 +1,176 @@
+"""Timings of each stage of the pipeline, exported as Prometheus metrics.
+
+Stages are timed with `span`, which records into a histogram per stage:
+
+    with span("download"):
+        ...
+
+The histograms, error counters, and the gauges and counters of registered
+collectors, like the patch cache and rate governor stats, are rendered in the
+Prometheus text format by `render_prometheus`, which the prediction server
+serves at /metrics.
+
+Setting `WEATHER_TRACE_LOG=1` also logs every span as a JSON line to the
+"weather.trace" logger, for tracing individual requests.
+"""
+
+from __future__ import annotations
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any as AnyType, Callable, Iterable, Iterator
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TRACE_LOG = os.environ.get("WEATHER_TRACE_LOG", "") not in ("", "0")
+
+trace_logger = logging.getLogger("weather.trace")
+
+
+class Histogram:
+    """Cumulative distribution of observed durations."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+class Metrics:
+    """Process-wide registry of stage histograms and metric collectors."""
+
+    def __init__(self) -> None:
+        self.stages: dict[str, Histogram] = {}
+        # Maps each prefix to its collect function and the names of its counters.
+        self.collectors: dict[
+            str, tuple[Callable[[], dict[str, AnyType]], frozenset[str]]
+        ] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, error: bool = False) -> None:
+        """Records the duration of a stage."""
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+            histogram.errors += error
+
+    def register(
+        self,
+        prefix: str,
+        collect: Callable[[], dict[str, AnyType]],
+        counters: Iterable[str] = (),
+    ) -> None:
+        """Registers a function returning metrics, exported as `<prefix>_<name>`.
+
+        Args:
+            prefix: Prefix of the metric names.
+            collect: Function returning the current value of every metric.
+            counters: Names of the cumulative values, like hits or retries,
+                exported as counters named `<prefix>_<name>_total`.
+                The other values are exported as gauges.
+        """
+        with self.lock:
+            self.collectors[prefix] = (collect, frozenset(counters))
+
+    def snapshot(self) -> dict[str, tuple[int, float]]:
+        """Gets the (count, total seconds) of every stage so far."""
+        with self.lock:
+            return {stage: (h.count, h.sum) for stage, h in self.stages.items()}
+
+    def render_prometheus(self) -> str:
+        """Renders all the metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP weather_stage_seconds Time spent in each stage of the pipeline.",
+            "# TYPE weather_stage_seconds histogram",
+        ]
+        with self.lock:
+            stages = sorted(self.stages.items())
+            collectors = sorted(self.collectors.items())
+            for stage, histogram in stages:
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    labels = f'stage="{stage}",le="{bound}"'
+                    lines.append(
+                        f"weather_stage_seconds_bucket{{{labels}}} {cumulative}"
+                    )
+                lines.append(
+                    f'weather_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}'
+                )
+                lines.append(
+                    f'weather_stage_seconds_count{{stage="{stage}"}} {histogram.count}'
+                )
+            lines.append("# HELP weather_stage_errors_total Stages that raised errors.")
+            lines.append("# TYPE weather_stage_errors_total counter")
+            for stage, histogram in stages:
+                lines.append(
+                    f'weather_stage_errors_total{{stage="{stage}"}} {histogram.errors}'
+                )
+
+        for prefix, (collect, counters) in collectors:
+            for name, value in collect().items():
+                if not isinstance(value, (int, float)):
+                    continue
+                if name in counters:
+                    lines.append(f"# TYPE {prefix}_{name}_total counter")
+                    lines.append(f"{prefix}_{name}_total {value}")
+                else:
+                    lines.append(f"# TYPE {prefix}_{name} gauge")
+                    lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Metrics shared by the whole process.
+metrics = Metrics()
+
+
+@contextmanager
+def span(stage: str, **fields: AnyType) -> Iterator[None]:
+    """Times a stage of the pipeline, recording it even if it raises.
+
+    Args:
+        stage: Name of the stage.
+        fields: Extra fields for the structured trace log.
+    """
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe(stage, seconds, error)
+        if TRACE_LOG:
+            record = {"span": stage, "seconds": seconds, "error": error} | fields
+            trace_logger.info(json.dumps(record, default=str))
+
+
+def get_breakdown(
+    before: dict[str, tuple[int, float]], after: dict[str, tuple[int, float]]
+) -> dict[str, float]:
+    """Gets the seconds spent in each stage between two snapshots.
+
+    Other threads record into the same metrics, so concurrent requests
+    are included in the breakdown too.
+    """
+    breakdown = {}
+    for stage, (count, total) in after.items():
+        previous_count, previous_total = before.get(stage, (0, 0.0))
+        if count > previous_count:
+            breakdown[stage] = total - previous_total
+    return breakdown
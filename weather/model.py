@@ -16,13 +16,18 @@
 
 from __future__ import annotations
 
-from typing import Any as AnyType, Optional
+from typing import TYPE_CHECKING, Any as AnyType, Optional
 
-from datasets.arrow_dataset import Dataset
 import numpy as np
 import torch
 from transformers import PretrainedConfig, PreTrainedModel
 
+from weather.inference import InferenceEngine
+
+if TYPE_CHECKING:
+    # Only needed for training, and importing it is slow.
+    from datasets.arrow_dataset import Dataset
+
 
 class WeatherConfig(PretrainedConfig):
     """A custom Hugging Face config for a WeatherModel.
@@ -81,6 +86,7 @@ class WeatherModel(PreTrainedModel):
             torch.nn.Linear(config.num_hidden2, config.num_outputs),
             torch.nn.ReLU(),  # precipitation cannot be negative
         )
+        self.engine: Optional[InferenceEngine] = None
 
     def forward(
         self, inputs: torch.Tensor, labels: Optional[torch.Tensor] = None
@@ -110,27 +116,42 @@ class WeatherModel(PreTrainedModel):
         return {"loss": loss, "logits": predictions}
 
     @staticmethod
-    def create(inputs: Dataset, **kwargs: AnyType) -> WeatherModel:
+    def create(
+        inputs: Dataset, num_workers: Optional[int] = None, **kwargs: AnyType
+    ) -> WeatherModel:
         """Creates a new WeatherModel calculating the
-        mean and standard deviation from a dataset."""
-        data = np.array(inputs, np.float32)
-        mean = data.mean(axis=(0, 1, 2))[None, None, None, :]
-        std = data.std(axis=(0, 1, 2))[None, None, None, :]
+        mean and standard deviation from a dataset.
+
+        The statistics are computed in batches, so the dataset doesn't need
+        to fit in memory, see `weather.stats.compute_stats`.
+        """
+        from weather.stats import compute_stats
+
+        stats = compute_stats(inputs, num_workers=num_workers)
+        mean = stats.mean.astype(np.float32)[None, None, None, :]
+        std = stats.std.astype(np.float32)[None, None, None, :]
         config = WeatherConfig(mean.tolist(), std.tolist(), **kwargs)
         return WeatherModel(config)
 
     def predict(self, inputs: AnyType) -> np.ndarray:
         """Predicts a single request."""
-        return self.predict_batch(torch.as_tensor([inputs]))[0]
+        return self.get_engine().predict(inputs)
 
     def predict_batch(self, inputs_batch: AnyType) -> np.ndarray:
         """Predicts a batch of requests."""
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model = self.to(device)
-        with torch.no_grad():
-            outputs = model(torch.as_tensor(inputs_batch, device=device))
-            predictions = outputs["logits"]
-            return predictions.cpu().numpy()
+        return self.get_engine().predict_batch(inputs_batch)
+
+    def get_engine(self) -> InferenceEngine:
+        """Gets the inference engine for this model, creating it on first use.
+
+        The engine runs an optimized copy of this model, see `weather.optimize`,
+        so weight changes made afterwards are not reflected in predictions.
+        """
+        if self.engine is None:
+            from weather.optimize import optimize_for_inference
+
+            self.engine = InferenceEngine(optimize_for_inference(self))
+        return self.engine
 
 
 class Normalization(torch.nn.Module):
@@ -0,0 +1,94 @@
+"""Streaming decoder for NPY payloads.
+
+Earth Engine returns patches as structured NPY arrays with one float32 field
+per band. A record of N float32 fields has exactly the same memory layout as
+N consecutive float32 values, so the payload can be read straight from the
+response stream into a channels-last float32 buffer, without buffering the
+response, copying it, or loading it with pickle.
+"""
+
+from __future__ import annotations
+
+import math
+from typing import BinaryIO, Optional
+
+import numpy as np
+from numpy.lib import format as npy_format
+from numpy.lib.recfunctions import structured_to_unstructured
+
+from weather.metrics import span
+
+FLOAT32 = np.dtype("<f4")
+
+
+def read_npy(
+    stream: BinaryIO,
+    out: Optional[np.ndarray] = None,
+    max_bytes: Optional[int] = None,
+) -> np.ndarray:
+    """Reads an NPY payload as a float32 array with shape (height, width, bands).
+
+    Args:
+        stream: File-like object positioned at the start of the payload.
+        out: Optional C-contiguous float32 array to decode into,
+            for example a slot of a preallocated batch.
+        max_bytes: Optional limit on the size of the array in the payload,
+            checked against its header before allocating anything.
+
+    Raises:
+        ValueError: If the payload is malformed, too large, or doesn't fit `out`.
+
+    Returns: The decoded array, which is `out` if it was passed.
+    """
+    version = npy_format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_1_0(stream)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = npy_format.read_array_header_2_0(stream)
+    else:
+        raise ValueError(f"Unsupported NPY format version: {version}")
+    if fortran_order:
+        raise ValueError("Fortran ordered NPY payloads are not supported")
+
+    # Structured payloads have a field per band, others have the bands last,
+    # or a single band.
+    names = dtype.names or ()
+    if len(shape) != 2 and (names or len(shape) != 3):
+        raise ValueError(f"Unexpected NPY payload shape: {shape}")
+    size = math.prod(shape) * dtype.itemsize
+    if max_bytes is not None and size > max_bytes:
+        raise ValueError(f"NPY payload of {size} bytes is over {max_bytes} bytes")
+
+    bands = len(names) if names else (shape[2] if len(shape) == 3 else 1)
+    out_shape = (shape[0], shape[1], bands)
+    if out is None:
+        out = np.empty(out_shape, np.float32)
+    elif out.shape != out_shape or out.dtype != np.float32:
+        raise ValueError(f"Expected an output of {out_shape} float32, got {out.shape}")
+
+    if names:
+        same_layout = dtype == np.dtype([(name, FLOAT32) for name in names])
+    else:
+        same_layout = dtype == FLOAT32
+    if same_layout:
+        # Read the payload directly into the output buffer, no copies.
+        read_into(stream, memoryview(out).cast("B"))
+        return out
+
+    # Any other layout goes through a temporary buffer and gets converted.
+    data = np.empty(shape, dtype)
+    read_into(stream, memoryview(data).cast("B"))
+    if names:
+        with span("structured_to_unstructured"):
+            data = structured_to_unstructured(data)
+    out[...] = data.reshape(out_shape)
+    return out
+
+
+def read_into(stream: BinaryIO, buffer: memoryview) -> None:
+    """Fills a buffer from a stream, raising ValueError if the stream ends early."""
+    while buffer.nbytes:
+        size = stream.readinto(buffer)
+        if not size:
+            raise ValueError("Unexpected end of the NPY payload")
+        buffer = buffer[size:]
@@ -0,0 +1,166 @@
+"""Rewrites a WeatherModel into an equivalent graph that's cheaper to run.
+
+The trained model normalizes every input channel, moves the channels first
+for the convolutions, and moves them back last for the final Linear layer.
+For inference, the normalization can be folded into the first convolution,
+since subtracting the mean and dividing by the standard deviation is linear,
+and the final Linear layer is the same as a 1x1 convolution.
+
+Inputs come in channels-last, so permuting them to (batch, channels, height,
+width) is just a view of a channels-last tensor. With the convolutions in the
+channels-last memory format, the whole network runs without any layout
+shuffles, and permuting the outputs back is also just a view.
+"""
+
+from __future__ import annotations
+
+import copy
+from typing import Optional
+
+import torch
+
+from weather.model import MoveDim, Normalization, WeatherConfig, WeatherModel
+
+
+class FusedWeatherNet(torch.nn.Module):
+    """Inference-only equivalent of `WeatherModel.layers`.
+
+    Args:
+        conv: First convolution, with the input normalization folded in.
+        conv_transpose: Transposed convolution.
+        head: 1x1 convolution replacing the final Linear layer.
+        config: Config of the original model.
+    """
+
+    def __init__(
+        self,
+        conv: torch.nn.Conv2d,
+        conv_transpose: torch.nn.ConvTranspose2d,
+        head: torch.nn.Conv2d,
+        config: WeatherConfig,
+    ) -> None:
+        super().__init__()
+        self.config = config
+        self.conv = conv
+        self.conv_transpose = conv_transpose
+        self.head = head
+        self.to(memory_format=torch.channels_last)
+
+    def forward(
+        self, inputs: torch.Tensor, labels: Optional[torch.Tensor] = None
+    ) -> dict[str, torch.Tensor]:
+        x = inputs.permute(0, 3, 1, 2)  # channels-last view, no copies
+        x = torch.relu(self.conv(x))
+        x = torch.relu(self.conv_transpose(x))
+        x = torch.relu(self.head(x))  # precipitation cannot be negative
+        return {"logits": x.permute(0, 2, 3, 1)}
+
+
+def optimize_for_inference(model: WeatherModel, check: bool = True) -> FusedWeatherNet:
+    """Creates an inference graph equivalent to a WeatherModel.
+
+    The original model is left untouched.
+
+    Args:
+        model: Model to optimize.
+        check: Whether to verify the new graph against the original one.
+
+    Raises:
+        ValueError: If the model doesn't have the expected layers,
+            or the optimized graph doesn't match the original.
+
+    Returns: The optimized model.
+    """
+    layers = list(model.layers)
+    types = [type(layer) for layer in layers]
+    expected = [
+        Normalization,
+        MoveDim,
+        torch.nn.Conv2d,
+        torch.nn.ReLU,
+        torch.nn.ConvTranspose2d,
+        torch.nn.ReLU,
+        MoveDim,
+        torch.nn.Linear,
+        torch.nn.ReLU,
+    ]
+    if types != expected:
+        raise ValueError(f"Unexpected layers: {[t.__name__ for t in types]}")
+    normalization, _, conv, _, conv_transpose, _, _, linear, _ = layers
+
+    with torch.no_grad():
+        fused_conv = fold_normalization(normalization, conv)
+        head = torch.nn.Conv2d(linear.in_features, linear.out_features, 1)
+        head.weight.copy_(linear.weight[:, :, None, None])
+        head.bias.copy_(linear.bias)
+
+    optimized = FusedWeatherNet(
+        fused_conv, copy.deepcopy(conv_transpose), head, model.config
+    )
+    optimized = optimized.to(model.device).eval()
+    if check:
+        check_equivalence(model, optimized)
+    return optimized
+
+
+def fold_normalization(
+    normalization: Normalization, conv: torch.nn.Conv2d
+) -> torch.nn.Conv2d:
+    """Folds a z-score normalization into the convolution that follows it.
+
+    conv((x - mean) / std) = conv'(x), where the weights are divided by the
+    std of their input channel, and the bias is adjusted to subtract the mean.
+    This is only exact without padding, since padded zeros aren't normalized.
+    """
+    if conv.padding != (0, 0) or conv.groups != 1:
+        raise ValueError("Can only fold a normalization into an unpadded convolution")
+
+    mean = normalization.mean.reshape(-1)
+    std = normalization.std.reshape(-1)
+    weight = conv.weight / std[None, :, None, None]
+    bias = conv.bias - (weight * mean[None, :, None, None]).sum(dim=(1, 2, 3))
+
+    fused = torch.nn.Conv2d(
+        conv.in_channels,
+        conv.out_channels,
+        conv.kernel_size,
+        stride=conv.stride,
+        dilation=conv.dilation,
+    )
+    fused.weight.copy_(weight)
+    fused.bias.copy_(bias)
+    return fused
+
+
+def check_equivalence(
+    original: torch.nn.Module,
+    optimized: torch.nn.Module,
+    patch_size: int = 16,
+    rtol: float = 1e-3,
+    atol: float = 1e-3,
+) -> float:
+    """Checks that two models predict the same outputs for realistic inputs.
+
+    The inputs are drawn from the original model's normalization statistics.
+
+    Raises:
+        ValueError: If the predictions don't match within the tolerances.
+
+    Returns: The maximum absolute difference between the predictions.
+    """
+    config = original.config
+    mean = torch.as_tensor(config.mean, dtype=torch.float32).reshape(-1)
+    std = torch.as_tensor(config.std, dtype=torch.float32).reshape(-1)
+    generator = torch.Generator().manual_seed(0)
+    noise = torch.randn((2, patch_size, patch_size, len(mean)), generator=generator)
+    inputs = (mean + std * noise).abs().to(next(original.parameters()).device)
+
+    with torch.inference_mode():
+        expected = original(inputs)["logits"]
+        actual = optimized(inputs)["logits"]
+    difference = (expected - actual).abs().max().item()
+    try:
+        torch.testing.assert_close(actual, expected, rtol=rtol, atol=atol)
+    except AssertionError as e:
+        raise ValueError(f"Optimized model doesn't match the original: {e}")
+    return difference
@@ -0,0 +1,208 @@
+"""Compact storage of patches as 16 bit values with per-band scale and offset.
+
+Input patches are float32, but GOES 16 reflectances and GPM precipitation
+rates don't need that much precision, and elevation is integral. A packed
+patch stores every band as either:
+    int16: the band's range linearly mapped to 16 bit integers. Integral bands
+        that fit in the range, like elevation, are stored exactly.
+    float16: half precision floats, scaled down only if they would overflow.
+
+Packed patches are half the size of float32 patches, which is what the patch
+cache and the frame cache keep them as if they're given a packing. They're
+decoded back to float32 when they're read from a cache, since every patch is
+then stacked into float32 inputs. Packed patches can be saved to disk and
+memory-mapped back with `save_packed` and `load_packed`.
+
+To report the round-trip error of every band of some patches:
+
+    python -m weather.packing patches.npy --packing int16
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any as AnyType, BinaryIO, Optional
+
+import numpy as np
+from numpy.lib import format as npy_format
+
+PACKINGS = ("int16", "float16")
+
+# The lowest int16 value encodes NaN, so the range is symmetric around zero.
+INT16_NAN = -32768
+INT16_MAX = 32767
+FLOAT16_MAX = 65504
+
+
+@dataclass
+class PackedPatch:
+    """Patch of pixels stored as 16 bit values, decoded as `values * scale + offset`.
+
+    Indexing selects along the leading axes, like patches in a batch, and
+    converting it to an array with `np.asarray` decodes it to a new float32
+    array, so it can't be converted without a copy.
+    """
+
+    values: np.ndarray  # int16 or float16 with shape (..., bands)
+    scale: np.ndarray  # float32 with shape (bands,)
+    offset: np.ndarray  # float32 with shape (bands,)
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.values.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.scale.nbytes + self.offset.nbytes
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, index: AnyType) -> PackedPatch:
+        return PackedPatch(self.values[index], self.scale, self.offset)
+
+    def __array__(
+        self, dtype: AnyType = None, copy: Optional[bool] = None
+    ) -> np.ndarray:
+        if copy is False:
+            raise ValueError("A packed patch can't be converted without decoding it")
+        array = self.decode()
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def decode(self, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Decodes the patch to float32.
+
+        Args:
+            out: Optional float32 array to write the patch into.
+
+        Returns: The decoded patch with the same shape as the values.
+        """
+        out = np.empty(self.values.shape, np.float32) if out is None else out
+        np.multiply(self.values, self.scale, out=out, casting="unsafe")
+        out += self.offset
+        if self.values.dtype == np.int16:
+            out[self.values == INT16_NAN] = np.nan
+        return out
+
+
+def pack(patch: np.ndarray, packing: str = "int16") -> PackedPatch:
+    """Packs a float32 patch into 16 bit values.
+
+    Args:
+        patch: Array with shape (..., bands), like a patch or a batch of them.
+        packing: One of `PACKINGS`.
+
+    Returns: The packed patch.
+    """
+    patch = np.asarray(patch, np.float32)
+    bands = patch.reshape(-1, patch.shape[-1])
+    nan = np.isnan(bands)
+    low = np.where(nan, np.inf, bands).min(axis=0)
+    high = np.where(nan, -np.inf, bands).max(axis=0)
+    # Bands that are all NaN have nothing to scale.
+    low, high = np.where(low > high, 0, low), np.where(low > high, 0, high)
+
+    if packing == "float16":
+        scale = np.maximum(np.maximum(-low, high) / FLOAT16_MAX, 1).astype(np.float32)
+        offset = np.zeros_like(scale)
+        values = (patch / scale).astype(np.float16)
+        return PackedPatch(values, scale, offset)
+
+    if packing != "int16":
+        raise ValueError(f"Unknown packing {packing!r}, expected one of {PACKINGS}")
+    center = (low + high) / 2
+    scale = (high - low) / (2 * INT16_MAX)
+    # Integral bands that fit are stored exactly, with unit steps.
+    integral = np.all((bands == np.round(bands)) | nan, axis=0)
+    exact = integral & (high - low <= 2 * INT16_MAX)
+    offset = np.where(exact, np.round(center), center).astype(np.float32)
+    scale = np.where(exact | (scale == 0), 1, scale).astype(np.float32)
+    values = np.round((patch - offset) / scale)
+    nan = np.isnan(values)
+    values[nan] = 0
+    np.clip(values, -INT16_MAX, INT16_MAX, out=values)
+    values = values.astype(np.int16)
+    values[nan] = INT16_NAN
+    return PackedPatch(values, scale, offset)
+
+
+def get_round_trip_error(
+    patch: np.ndarray, packed: PackedPatch
+) -> dict[str, np.ndarray]:
+    """Gets the error of every band after packing and decoding a patch.
+
+    Args:
+        patch: The original float32 patch.
+        packed: The patch packed with `pack`.
+
+    Returns: The "max" absolute error and "rms" error of every band.
+    """
+    patch = np.asarray(patch, np.float32)
+    error = (packed.decode() - patch).reshape(-1, patch.shape[-1])
+    error = np.where(np.isnan(error) & np.isnan(patch.reshape(error.shape)), 0, error)
+    return {
+        "max": np.abs(error).max(axis=0),
+        "rms": np.sqrt(np.mean(error**2, axis=0)),
+    }
+
+
+def save_packed(file: BinaryIO, packed: PackedPatch) -> None:
+    """Saves a packed patch as two consecutive NPY arrays.
+
+    The first one has the (scale, offset) of every band, and the second one
+    has the values, so it can be memory-mapped, see `load_packed`.
+    """
+    np.save(file, np.stack([packed.scale, packed.offset]), allow_pickle=False)
+    np.save(file, packed.values, allow_pickle=False)
+
+
+def load_packed(path: str | Path, mmap: bool = True) -> PackedPatch:
+    """Loads a packed patch saved with `save_packed`.
+
+    Args:
+        path: File to load.
+        mmap: Whether to memory-map the values read-only instead of reading them.
+
+    Returns: The packed patch.
+    """
+    with open(path, "rb") as f:
+        scale, offset = npy_format.read_array(f)
+        if not mmap:
+            return PackedPatch(npy_format.read_array(f), scale, offset)
+        version = npy_format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = npy_format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = npy_format.read_array_header_2_0(f)
+        else:
+            raise ValueError(f"Unsupported NPY format version: {version}")
+        start = f.tell()
+    order = "F" if fortran_order else "C"
+    values = np.memmap(path, dtype, "r", offset=start, shape=shape, order=order)
+    return PackedPatch(values, scale, offset)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("patches", help="NPY file with patches, bands last.")
+    parser.add_argument("--packing", choices=PACKINGS, default="int16")
+    args = parser.parse_args()
+
+    patches = np.load(args.patches, mmap_mode="r")
+    packed = pack(patches, args.packing)
+    errors = get_round_trip_error(patches, packed)
+    ratio = packed.nbytes / np.asarray(patches, np.float32).nbytes
+    print(f"{args.packing}: {packed.nbytes:,} bytes, {ratio:.0%} of float32")
+    columns = ["band", "scale", "offset", "max error", "rms error"]
+    print("  ".join(f"{column:>12}" for column in columns))
+    for band in range(packed.shape[-1]):
+        print(
+            f"{band:>12}  {packed.scale[band]:>12.6g}  {packed.offset[band]:>12.6g}"
+            f"  {errors['max'][band]:>12.6g}  {errors['rms'][band]:>12.6g}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Inference engine running a model in a pool of worker processes.
+
+A single process can't use every core to predict concurrent requests, since
+the Python parts of each request hold the GIL. Spreading batches across
+worker processes scales with the number of cores instead, without copying
+the model or the data for every process:
+
+    - Weights: the model's tensors are moved to shared memory once, and every
+      worker maps the same pages instead of loading its own copy.
+    - Inputs and outputs: every worker has its own shared-memory buffers.
+      Batches are copied straight into them and only their shapes are sent
+      through a pipe, rather than pickling the arrays.
+    - Threads: the intra-op threads are split between the workers, so they
+      don't oversubscribe the cores by each using all of them.
+
+Workers are started with the "spawn" method, so scripts using the pool must
+create it under an `if __name__ == "__main__":` guard.
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import queue
+import threading
+import weakref
+from typing import Any as AnyType, Optional
+
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+
+
+class ProcessPoolEngine:
+    """Runs a model in several worker processes that share its weights.
+
+    Large batches are split across the idle workers and predicted in parallel.
+
+    Args:
+        model: Model to run, like an `InferenceEngine` model.
+        num_workers: Number of worker processes, defaults to a worker for
+            every 4 cores.
+        num_threads: Total number of intra-op threads, split evenly between
+            the workers, defaults to the number of cores.
+        max_batch_size: Maximum number of patches each worker predicts at once.
+        patch_size: Size in pixels of the largest patches to predict.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        num_workers: Optional[int] = None,
+        num_threads: Optional[int] = None,
+        max_batch_size: int = 8,
+        patch_size: int = 128,
+    ) -> None:
+        num_cores = os.cpu_count() or 1
+        self.num_workers = num_workers or max(1, num_cores // 4)
+        self.num_threads = max(1, (num_threads or num_cores) // self.num_workers)
+        self.num_inputs = model.config.num_inputs
+        self.max_batch_size = max_batch_size
+
+        # Measure how many output values there are for each input pixel,
+        # the ensemble has one set of outputs per member.
+        model = model.eval()
+        with torch.inference_mode():
+            probe = model(torch.zeros(1, 8, 8, self.num_inputs))["logits"]
+        max_pixels = max_batch_size * patch_size * patch_size
+        self.max_inputs = max_pixels * self.num_inputs
+        self.max_outputs = max_pixels * probe.numel() // (8 * 8)
+
+        # Workers map the same weights, inputs and outputs instead of copying them.
+        model.share_memory()
+        context = multiprocessing.get_context("spawn")
+        self.workers: list[Worker] = []
+        for _ in range(self.num_workers):
+            inputs = torch.zeros(self.max_inputs).share_memory_()
+            outputs = torch.zeros(self.max_outputs).share_memory_()
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=run_worker,
+                args=(model, inputs, outputs, self.num_threads, worker_connection),
+                daemon=True,
+            )
+            process.start()
+            worker_connection.close()
+            self.workers.append(Worker(process, connection, inputs, outputs))
+
+        # Idle workers, or None once every worker died, to fail the callers.
+        self.idle: queue.Queue[Optional[Worker]] = queue.Queue()
+        self.lock = threading.Lock()
+        for worker in self.workers:
+            message = worker.connection.recv()  # wait until it's ready
+            if message is not None:
+                close_workers(self.workers)
+                raise RuntimeError(f"Inference worker failed to start: {message}")
+            self.idle.put(worker)
+        self.finalizer = weakref.finalize(self, close_workers, self.workers)
+
+    def predict(self, inputs: AnyType) -> np.ndarray:
+        """Predicts a single request."""
+        return self.predict_batch(np.asarray(inputs, np.float32)[None])[0]
+
+    def predict_batch(self, inputs_batch: AnyType) -> np.ndarray:
+        """Predicts a batch of requests across the idle workers.
+
+        Args:
+            inputs_batch: Inputs with shape (batch, height, width, channels).
+
+        Raises:
+            ValueError: If a single patch is larger than the workers' buffers.
+            RuntimeError: If a worker failed to predict.
+
+        Returns: The predictions with shape (batch, height, width, outputs).
+        """
+        array = np.asarray(inputs_batch, np.float32)
+        patch_inputs = math.prod(array.shape[1:])
+        if patch_inputs > self.max_inputs // self.max_batch_size:
+            raise ValueError(f"Patches of {array.shape[1:]} don't fit the buffers")
+
+        results = []
+        start = 0
+        while start < len(array):
+            # Block for one worker, but only take other workers if they're idle,
+            # so concurrent callers never wait on each other's workers.
+            workers = [self.get_idle()]
+            while len(workers) < len(array) - start:
+                try:
+                    workers.append(self.get_idle(block=False))
+                except queue.Empty:
+                    break
+            remaining = len(array) - start
+            chunk_size = min(self.max_batch_size, math.ceil(remaining / len(workers)))
+
+            chunks = []
+            for worker in workers:
+                chunk = array[start : start + chunk_size]
+                if len(chunk) == 0:
+                    self.idle.put(worker)
+                    continue
+                worker.inputs.numpy()[: chunk.size] = chunk.reshape(-1)
+                try:
+                    worker.connection.send(chunk.shape)
+                except OSError:
+                    self.discard(worker)  # the next workers take its chunk
+                    continue
+                chunks.append(worker)
+                start += len(chunk)
+
+            # Wait for every worker even if one failed, so none is left out of
+            # the pool with an unread reply.
+            errors = []
+            for worker in chunks:
+                try:
+                    results.append(self.receive(worker))
+                except RuntimeError as e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+        return np.concatenate(results)
+
+    def get_idle(self, block: bool = True) -> Worker:
+        """Takes an idle worker out of the pool.
+
+        Raises:
+            queue.Empty: If none is idle and `block` is False.
+            RuntimeError: If every worker died.
+        """
+        worker = self.idle.get(block)
+        if worker is None:
+            self.idle.put(None)  # for the other callers
+            raise RuntimeError("Every inference worker died")
+        return worker
+
+    def receive(self, worker: Worker) -> np.ndarray:
+        """Waits for a worker's predictions, and puts it back in the pool.
+
+        Raises:
+            RuntimeError: If the worker failed to predict, or died.
+        """
+        try:
+            shape, error = worker.connection.recv()
+        except (EOFError, OSError):
+            self.discard(worker)
+            raise RuntimeError(f"Inference worker {worker.process.pid} died")
+        try:
+            if error is not None:
+                raise RuntimeError(f"Inference worker failed: {error}")
+            return worker.outputs.numpy()[: math.prod(shape)].reshape(shape).copy()
+        finally:
+            self.idle.put(worker)
+
+    def discard(self, worker: Worker) -> None:
+        """Removes a dead worker from the pool."""
+        with self.lock:
+            self.workers.remove(worker)
+            if not self.workers:
+                self.idle.put(None)
+        worker.process.join(timeout=1)
+        worker.connection.close()
+
+    def close(self) -> None:
+        """Stops the worker processes."""
+        self.finalizer()
+
+
+class Worker:
+    """Handle to a worker process and its shared buffers."""
+
+    def __init__(
+        self,
+        process: AnyType,
+        connection: AnyType,
+        inputs: torch.Tensor,
+        outputs: torch.Tensor,
+    ) -> None:
+        self.process = process
+        self.connection = connection
+        self.inputs = inputs
+        self.outputs = outputs
+
+
+def close_workers(workers: list[Worker]) -> None:
+    """Asks the workers to stop, and waits for them."""
+    for worker in workers:
+        try:
+            worker.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+    for worker in workers:
+        worker.process.join(timeout=10)
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.connection.close()
+
+
+def run_worker(
+    model: torch.nn.Module,
+    inputs: torch.Tensor,
+    outputs: torch.Tensor,
+    num_threads: int,
+    connection: AnyType,
+) -> None:
+    """Predicts the batches written to the shared inputs until told to stop."""
+    try:
+        from weather.inference import InferenceEngine
+
+        torch.set_num_interop_threads(1)
+        engine = InferenceEngine(
+            model, device="cpu", num_threads=num_threads, warmup=False
+        )
+    except Exception as e:
+        connection.send(repr(e))
+        return
+    connection.send(None)
+
+    while True:
+        shape = connection.recv()
+        if shape is None:
+            return
+        try:
+            batch = inputs.numpy()[: math.prod(shape)].reshape(shape)
+            predictions = engine.predict_batch(batch)
+            outputs.numpy()[: predictions.size] = predictions.reshape(-1)
+            connection.send((predictions.shape, None))
+        except Exception as e:
+            connection.send((None, repr(e)))
@@ -0,0 +1,264 @@
+"""Quantized variants of a model for faster CPU inference.
+
+Two variants are supported:
+    int8: static post-training quantization of the first convolution and
+        the head, calibrated on real input patches. The inputs are normalized
+        in float32 first, see `NormalizedNet`.
+    bf16: the whole network in bfloat16, with float32 inputs and outputs.
+
+Each variant is saved as a TorchScript file next to the pretrained weights,
+and can be served with `load_engine(model_dir, precision=...)`. Before saving,
+the predictions of the variant are compared against the float32 model on a
+held-out set of patches, and the variant is rejected if they deviate too much.
+
+To quantize a model:
+
+    python -m weather.quantize models/26_100_epochs_tropics int8 \\
+        --calibration calibration.npy --holdout holdout.npy
+
+The patch files are NPY arrays with shape (patches, height, width, channels).
+To only check that a variant passes, on patches drawn from the model's
+normalization statistics, without saving it:
+
+    python -m weather.quantize models/26_100_epochs_tropics int8 --check
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+from pathlib import Path
+import sys
+from typing import Any as AnyType, Optional
+
+import numpy as np
+import torch
+
+from weather.export import LogitsOnly
+from weather.model import Normalization, WeatherModel
+from weather.optimize import FusedWeatherNet, optimize_for_inference
+from weather.runtime import quantized_filename
+
+
+class CastTo(torch.nn.Module):
+    """Runs a model in another dtype, with float32 inputs and outputs."""
+
+    def __init__(self, model: torch.nn.Module, dtype: torch.dtype) -> None:
+        super().__init__()
+        self.model = model.to(dtype)
+        self.dtype = dtype
+
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        return self.model(inputs.to(self.dtype))["logits"].float()
+
+
+class NormalizedNet(torch.nn.Module):
+    """An optimized model with the normalization kept out of the first convolution.
+
+    Folding the normalization into the first convolution leaves the raw inputs
+    to be quantized with a single int8 scale, but elevation and cloud and
+    moisture values reach the thousands while precipitation is a few mm/h,
+    so the precipitation channels would round to zero. Normalizing in float32
+    first gives every channel a similar range before it's quantized.
+    """
+
+    def __init__(self, model: WeatherModel) -> None:
+        super().__init__()
+        normalization, _, conv, *_ = model.layers
+        self.normalization = copy.deepcopy(normalization)
+        self.model = optimize_for_inference(model)
+        self.model.conv = copy.deepcopy(conv).to(memory_format=torch.channels_last)
+
+    def forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        return self.model(self.normalization(inputs))["logits"]
+
+
+def quantize_int8(
+    model: WeatherModel, calibration: np.ndarray, batch_size: int = 8
+) -> torch.nn.Module:
+    """Quantizes the convolution and the head of a model to int8.
+
+    Args:
+        model: Model to quantize, it's left untouched.
+        calibration: Input patches to calibrate the activation ranges.
+        batch_size: Number of patches per calibration batch.
+
+    Returns: The quantized model.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    # The inputs are only quantized after normalizing them. The quantized
+    # transposed convolution of the x86 backend deviates by several mm/h on
+    # real checkpoints, so it stays in float32 between the other layers.
+    qconfig_mapping = (
+        get_default_qconfig_mapping("x86")
+        .set_object_type(Normalization, None)
+        .set_object_type(torch.nn.ConvTranspose2d, None)
+    )
+    example = torch.from_numpy(np.array(calibration[:1], np.float32))
+    prepared = prepare_fx(
+        NormalizedNet(model).eval(),
+        qconfig_mapping,
+        (example,),
+        prepare_custom_config={"non_traceable_module_class": [Normalization]},
+    )
+    with torch.no_grad():
+        for i in range(0, len(calibration), batch_size):
+            batch = np.array(calibration[i : i + batch_size], np.float32)
+            prepared(torch.from_numpy(batch))
+    return convert_fx(prepared)
+
+
+def quantize_bf16(model: FusedWeatherNet) -> torch.nn.Module:
+    """Converts a model to bfloat16, keeping float32 inputs and outputs."""
+    return CastTo(copy.deepcopy(model), torch.bfloat16).eval()
+
+
+def get_synthetic_patches(
+    config: AnyType, num_patches: int, patch_size: int = 64, seed: int = 0
+) -> np.ndarray:
+    """Draws realistic input patches from a model's normalization statistics."""
+    mean = np.asarray(config.mean, np.float32).reshape(-1)
+    std = np.asarray(config.std, np.float32).reshape(-1)
+    noise = np.random.default_rng(seed).standard_normal(
+        (num_patches, patch_size, patch_size, len(mean)), np.float32
+    )
+    return np.abs(mean + std * noise)
+
+
+def compare_predictions(
+    reference: AnyType, candidate: AnyType, patches: np.ndarray, batch_size: int = 8
+) -> dict[str, float]:
+    """Compares the predictions of two models on the same patches.
+
+    Args:
+        reference: Function predicting a batch with the reference model.
+        candidate: Function predicting a batch with the candidate model.
+        patches: Input patches with shape (patches, height, width, channels).
+        batch_size: Number of patches per batch.
+
+    Returns: The "max" and "mean" absolute deviation of the candidate.
+    """
+    max_deviation = 0.0
+    total_deviation = 0.0
+    count = 0
+    for i in range(0, len(patches), batch_size):
+        inputs = np.array(patches[i : i + batch_size], np.float32)
+        deviation = np.abs(candidate(inputs) - reference(inputs))
+        max_deviation = max(max_deviation, float(deviation.max()))
+        total_deviation += float(deviation.sum(dtype=np.float64))
+        count += deviation.size
+    return {"max": max_deviation, "mean": total_deviation / count}
+
+
+def quantize_model(
+    model_dir: str | Path,
+    precision: str,
+    holdout: np.ndarray,
+    calibration: Optional[np.ndarray] = None,
+    max_deviation: float = 2.0,
+    mean_deviation: float = 0.1,
+    save: bool = True,
+) -> dict[str, float]:
+    """Quantizes a pretrained model and saves it if it's accurate enough.
+
+    Args:
+        model_dir: Path to a pretrained model directory.
+        precision: Either "int8" or "bf16".
+        holdout: Input patches to measure the deviation on.
+        calibration: Input patches to calibrate int8 quantization on.
+        max_deviation: Maximum allowed deviation for any predicted pixel.
+        mean_deviation: Maximum allowed mean deviation over all pixels.
+        save: Whether to save the variant, or only check it.
+
+    Raises:
+        ValueError: If the predictions deviate more than allowed.
+
+    Returns: The "max" and "mean" absolute deviation of the predictions.
+    """
+    model_dir = Path(model_dir)
+    model = WeatherModel.from_pretrained(model_dir).to("cpu")
+    optimized = optimize_for_inference(model)
+    if precision == "int8":
+        if calibration is None:
+            raise ValueError("int8 quantization needs calibration patches")
+        quantized = quantize_int8(model, calibration)
+    elif precision == "bf16":
+        quantized = quantize_bf16(optimized)
+    else:
+        raise ValueError(f"Unknown precision {precision!r}")
+
+    def predictor(model: torch.nn.Module) -> AnyType:
+        def predict(inputs: np.ndarray) -> np.ndarray:
+            with torch.no_grad():
+                return model(torch.from_numpy(inputs)).numpy()
+
+        return predict
+
+    deviation = compare_predictions(
+        predictor(LogitsOnly(optimized)), predictor(quantized), holdout
+    )
+    if deviation["max"] > max_deviation or deviation["mean"] > mean_deviation:
+        raise ValueError(
+            f"{precision} predictions deviate too much from float32: {deviation}"
+        )
+    if not save:
+        return deviation
+
+    example = torch.from_numpy(np.array(holdout[:1], np.float32))
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, example)
+    torch.jit.save(
+        traced,
+        str(model_dir / quantized_filename(precision)),
+        _extra_files={"config.json": model.config.to_json_string()},
+    )
+    return deviation
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model_dir", help="Pretrained model directory.")
+    parser.add_argument("precision", choices=["int8", "bf16"])
+    parser.add_argument("--holdout", help="NPY file of patches.")
+    parser.add_argument("--calibration", help="NPY file of patches, for int8.")
+    parser.add_argument("--max-deviation", type=float, default=2.0)
+    parser.add_argument("--mean-deviation", type=float, default=0.1)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only check the variant, on synthetic patches unless given some.",
+    )
+    args = parser.parse_args()
+    if not args.holdout and not args.check:
+        parser.error("--holdout is required unless --check is given")
+
+    config = WeatherModel.config_class.from_pretrained(args.model_dir)
+    if args.holdout:
+        holdout = np.load(args.holdout, mmap_mode="r")
+    else:
+        holdout = get_synthetic_patches(config, 16, seed=1)
+    if args.calibration:
+        calibration = np.load(args.calibration, mmap_mode="r")
+    else:
+        calibration = get_synthetic_patches(config, 32) if args.check else None
+    try:
+        deviation = quantize_model(
+            args.model_dir,
+            args.precision,
+            holdout,
+            calibration,
+            args.max_deviation,
+            args.mean_deviation,
+            save=not args.check,
+        )
+    except ValueError as e:
+        sys.exit(str(e))
+    print(f"Deviation from float32: {deviation}")
+    if not args.check:
+        print(f"Saved {Path(args.model_dir) / quantized_filename(args.precision)}")
+
+
+if __name__ == "__main__":
+    main()
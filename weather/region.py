@@ -0,0 +1,178 @@
+"""Forecasts over large regions by tiling them into patches.
+
+The model is fully convolutional, so it can predict any region by splitting
+it into overlapping tiles the size it was trained on. Each tile's predictions
+are weighted down towards its edges, where the model has less context, and
+the overlapping tiles are blended into a single seamless raster.
+
+Tiles are fetched and predicted a batch at a time, so memory usage only
+depends on the batch size and the size of the output raster, which can also
+be memory-mapped to a file for very large regions.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import Future
+from datetime import datetime
+import math
+from typing import Any as AnyType, Iterator, Optional
+
+import numpy as np
+
+from weather.data import (
+    INPUT_BANDS,
+    METERS_PER_DEGREE,
+    SCALE,
+    PatchSource,
+    executor,
+    get_inputs_region,
+)
+
+# The tropics training area around Cape Canaveral, as (west, south, east, north).
+TROPICS = (-90.0, 18.0, -70.0, 36.0)
+
+
+def get_pixel_size(
+    bounds: tuple[float, float, float, float], scale: int = SCALE
+) -> tuple[float, float]:
+    """Gets the (dx, dy) size of a pixel in degrees for a bounding box.
+
+    Longitude pixels are widened by the latitude at the center of the box,
+    so pixels are roughly `scale` meters wide like in point-centered patches.
+    """
+    _, south, _, north = bounds
+    dy = scale / METERS_PER_DEGREE
+    dx = dy / math.cos(math.radians((south + north) / 2))
+    return (dx, dy)
+
+
+def get_region_shape(
+    bounds: tuple[float, float, float, float], scale: int = SCALE
+) -> tuple[int, int]:
+    """Gets the (height, width) in pixels of a bounding box."""
+    west, south, east, north = bounds
+    dx, dy = get_pixel_size(bounds, scale)
+    return (math.ceil((north - south) / dy), math.ceil((east - west) / dx))
+
+
+def check_overlap(tile_size: int, overlap: int) -> None:
+    """Checks that neighboring tiles overlap, but still move forward."""
+    if not 0 <= overlap < tile_size:
+        raise ValueError(
+            f"Overlap must be at least 0 and less than the tile size {tile_size},"
+            f" got {overlap}"
+        )
+
+
+def get_tile_starts(size: int, tile_size: int, overlap: int) -> list[int]:
+    """Gets the start offsets of overlapping tiles covering a dimension.
+
+    Raises:
+        ValueError: If the overlap isn't between 0 and the tile size, exclusive.
+    """
+    check_overlap(tile_size, overlap)
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def get_blend_weights(tile_size: int, overlap: int) -> np.ndarray:
+    """Gets the weights of a tile, ramping down linearly within the overlap."""
+    distance = np.minimum(np.arange(tile_size), np.arange(tile_size)[::-1]) + 1
+    ramp = np.minimum(distance / (overlap + 1), 1.0)
+    return np.outer(ramp, ramp).astype(np.float32)
+
+
+def forecast_region(
+    engine: AnyType,
+    date: datetime,
+    bounds: tuple[float, float, float, float],
+    tile_size: int = 128,
+    overlap: int = 32,
+    batch_size: int = 8,
+    scale: int = SCALE,
+    source: Optional[PatchSource] = None,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Predicts a whole region by blending overlapping tiles.
+
+    Args:
+        engine: Anything with a `predict_batch` method, like an `InferenceEngine`.
+        date: The date of interest.
+        bounds: A (west, south, east, north) bounding box in degrees.
+        tile_size: Size in pixels of the square tiles.
+        overlap: Number of pixels shared by neighboring tiles.
+        batch_size: Number of tiles to predict at once.
+        scale: Number of meters per pixel.
+        source: Where to get the inputs from, defaults to `get_patch_source()`.
+        out: Optional float32 array with shape (height, width, outputs) to write
+            the predictions into, like a memory-mapped file for large regions.
+
+    Returns: The predictions as a float32 NumPy array with
+        shape (height, width, outputs), see `get_region_shape`.
+
+    Raises:
+        ValueError: If the overlap isn't between 0 and the tile size, exclusive.
+    """
+    check_overlap(tile_size, overlap)
+    height, width = get_region_shape(bounds, scale)
+    dx, dy = get_pixel_size(bounds, scale)
+    west, _, _, north = bounds
+
+    # Regions smaller than a tile are padded to a full tile.
+    tiles = [
+        (row, col)
+        for row in get_tile_starts(height, tile_size, overlap)
+        for col in get_tile_starts(width, tile_size, overlap)
+    ]
+    weights = get_blend_weights(tile_size, overlap)
+
+    def fetch(row: int, col: int, out: np.ndarray) -> np.ndarray:
+        tile_west = west + col * dx
+        tile_north = north - row * dy
+        tile_bounds = (
+            tile_west,
+            tile_north - tile_size * dy,
+            tile_west + tile_size * dx,
+            tile_north,
+        )
+        return get_inputs_region(date, tile_bounds, (tile_size, tile_size), source, out)
+
+    def fetch_batches() -> Iterator[tuple[list, np.ndarray, list[Future]]]:
+        for i in range(0, len(tiles), batch_size):
+            batch_tiles = tiles[i : i + batch_size]
+            inputs = np.empty(
+                (len(batch_tiles), tile_size, tile_size, INPUT_BANDS), np.float32
+            )
+            futures = [
+                executor.submit(fetch, row, col, inputs[j])
+                for j, (row, col) in enumerate(batch_tiles)
+            ]
+            yield (batch_tiles, inputs, futures)
+
+    predictions_sum: Optional[np.ndarray] = None
+    weights_sum = np.zeros((height, width), np.float32)
+    batches = fetch_batches()
+    next_batch = next(batches, None)
+    while next_batch is not None:
+        batch_tiles, inputs, futures = next_batch
+        for future in futures:
+            future.result()
+
+        # Start downloading the next batch while this one is predicted.
+        next_batch = next(batches, None)
+        predictions = engine.predict_batch(inputs)
+
+        if predictions_sum is None:
+            shape = (height, width, predictions.shape[-1])
+            predictions_sum = np.zeros(shape, np.float32) if out is None else out
+            predictions_sum[...] = 0
+        for (row, col), tile in zip(batch_tiles, predictions):
+            h, w = min(tile_size, height - row), min(tile_size, width - col)
+            window = (slice(row, row + h), slice(col, col + w))
+            predictions_sum[window] += tile[:h, :w] * weights[:h, :w, None]
+            weights_sum[window] += weights[:h, :w]
+
+    predictions_sum /= weights_sum[..., None]
+    return predictions_sum
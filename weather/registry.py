@@ -0,0 +1,209 @@
+"""Loads models on first use and keeps only the recently used ones in memory.
+
+Loading every model when the app starts makes cold starts slow, so models
+are registered with a loader instead, and loaded the first time they're
+requested. When the loaded models go over a memory budget, or haven't been
+used for a while, the least recently used ones are evicted and will be
+loaded again on their next request.
+
+Pretrained weights are converted once from `pytorch_model.bin` to
+safetensors, which loads without unpickling. The converted weights are cached
+outside of the model directories, under `WEATHER_MODEL_CACHE_DIR`.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+import threading
+import time
+from typing import TYPE_CHECKING, Any as AnyType, Callable, Optional
+
+from weather.singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from weather.model import WeatherModel
+
+PYTORCH_FILENAME = "pytorch_model.bin"
+MODEL_CACHE_DIR = os.environ.get(
+    "WEATHER_MODEL_CACHE_DIR", os.path.expanduser("~/.cache/weather/models")
+)
+
+
+class ModelRegistry:
+    """Engines loaded on demand, with LRU eviction under a memory budget.
+
+    Args:
+        max_bytes: Maximum total size of the loaded models before evicting.
+        max_idle: Seconds after which an unused model is evicted, if set.
+    """
+
+    def __init__(self, max_bytes: int, max_idle: Optional[float] = None) -> None:
+        self.max_bytes = max_bytes
+        self.max_idle = max_idle
+        self.loaders: dict[str, tuple[Callable[[], AnyType], int]] = {}
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # Concurrent requests for a model that isn't loaded share a single load.
+        self.flights = SingleFlight()
+
+        # Maps each loaded name to its (engine, size in bytes, last used time),
+        # from least to most recently used.
+        self.engines: OrderedDict[str, tuple[AnyType, int, float]] = OrderedDict()
+        self.total_bytes = 0
+
+    def register(self, name: str, load: Callable[[], AnyType], size: int) -> None:
+        """Registers a model without loading it.
+
+        Args:
+            name: Name to get the model by.
+            load: Function that loads the engine for the model.
+            size: Approximate size of the loaded model in bytes,
+                see `get_weights_size`.
+        """
+        with self.lock:
+            self.loaders[name] = (load, size)
+
+    def get(self, name: str) -> AnyType:
+        """Gets the engine for a model, loading it if it's not loaded yet.
+
+        Models are loaded without holding the lock, so loading a model
+        doesn't block the requests for models that are already loaded.
+
+        Raises:
+            KeyError: If no model was registered with that name.
+        """
+        with self.lock:
+            self.evict_idle()
+            engine = self.touch(name)
+        if engine is None:
+            engine, _ = self.flights.do(name, self.load, name)
+        return engine
+
+    def touch(self, name: str) -> Optional[AnyType]:
+        """Marks a model as used, if it's loaded, holding the lock.
+
+        Returns: Its engine, or None if it's not loaded.
+        """
+        if name not in self.engines:
+            return None
+        engine, size, _ = self.engines.pop(name)
+        self.engines[name] = (engine, size, time.monotonic())
+        return engine
+
+    def load(self, name: str) -> AnyType:
+        """Loads a model, unless another load just finished, and evicts others."""
+        with self.lock:
+            engine = self.touch(name)
+            if engine is not None:
+                return engine
+            load, size = self.loaders[name]
+
+        engine = load()
+        with self.lock:
+            self.loads += 1
+            self.engines[name] = (engine, size, time.monotonic())
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.engines) > 1:
+                self.evict(next(iter(self.engines)))
+        return engine
+
+    def evict(self, name: str) -> None:
+        """Unloads a model, it's loaded again on its next request."""
+        _, size, _ = self.engines.pop(name)
+        self.total_bytes -= size
+        self.evictions += 1
+
+    def evict_idle(self) -> None:
+        """Unloads the models that haven't been used for `max_idle` seconds."""
+        if self.max_idle is None:
+            return
+        deadline = time.monotonic() - self.max_idle
+        for name, (_, _, last_used) in list(self.engines.items()):
+            if last_used < deadline:
+                self.evict(name)
+
+    def stats(self) -> dict[str, int]:
+        """Gets counters to monitor how effective the registry is."""
+        with self.lock:
+            return {
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "loaded": len(self.engines),
+                "bytes": self.total_bytes,
+            }
+
+
+def get_weights_size(model_dir: str | Path) -> int:
+    """Gets the size of the pretrained weights of a model in bytes."""
+    path = Path(model_dir) / PYTORCH_FILENAME
+    return path.stat().st_size if path.exists() else 0
+
+
+def get_safetensors_path(model_dir: str | Path) -> Path:
+    """Gets the path of the cached safetensors weights of a model.
+
+    The path depends on the location, size and modification time of the
+    original weights, so they're converted again if they change.
+    """
+    source = (Path(model_dir) / PYTORCH_FILENAME).resolve()
+    stat = source.stat()
+    key = f"{source}:{stat.st_size}:{stat.st_mtime_ns}"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return Path(MODEL_CACHE_DIR) / f"{source.parent.name}-{digest}.safetensors"
+
+
+def convert_to_safetensors(model_dir: str | Path) -> Path:
+    """Converts the pretrained weights of a model to safetensors, if needed.
+
+    Returns: The path to the cached safetensors weights.
+    """
+    import torch
+    from safetensors.torch import save_file
+
+    path = get_safetensors_path(model_dir)
+    if not path.exists():
+        state = torch.load(Path(model_dir) / PYTORCH_FILENAME, map_location="cpu")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        save_file({k: v.contiguous() for k, v in state.items()}, str(temp_path))
+        os.replace(temp_path, path)
+    return path
+
+
+def load_pretrained(model_dir: str | Path) -> WeatherModel:
+    """Loads a pretrained model from its cached safetensors weights.
+
+    Whether the weights stay mapped to the file is up to `safetensors`,
+    so the memory budget counts them in full, see `get_weights_size`.
+    If `safetensors` isn't installed, or the weights can't be converted,
+    this falls back to reading the weights with `from_pretrained`.
+
+    Args:
+        model_dir: Path to a pretrained model directory.
+
+    Returns: The pretrained model, in eval mode.
+    """
+    import torch
+
+    from weather.model import WeatherConfig, WeatherModel
+
+    try:
+        from safetensors.torch import load_file
+
+        path = convert_to_safetensors(model_dir)
+    except (ImportError, OSError):
+        return WeatherModel.from_pretrained(model_dir)
+
+    model = WeatherModel(WeatherConfig.from_pretrained(model_dir))
+    state = load_file(str(path))
+    parameters = dict(model.named_parameters())
+    if state.keys() != parameters.keys():
+        raise ValueError(f"Unexpected weights in {path}: {sorted(state)}")
+    with torch.no_grad():
+        for name, parameter in parameters.items():
+            parameter.data = state[name]
+    return model.eval()
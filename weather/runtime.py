@@ -0,0 +1,148 @@
+"""Runtime backends to serve predictions.
+
+Besides running the model eagerly in PyTorch, models exported with
+`weather.export` can be served from their TorchScript or ONNX graphs, which
+don't need the Hugging Face stack to load. The ONNX backend doesn't even need
+PyTorch, only `onnxruntime`.
+
+Every backend is an engine with `predict` and `predict_batch` methods taking
+channels-last float32 inputs, and a `num_inputs` attribute.
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any as AnyType, Optional
+
+import numpy as np
+
+from weather.metrics import span
+
+BACKENDS = ["torch", "torchscript", "onnx"]
+PRECISIONS = ["fp32", "bf16", "int8"]
+TORCHSCRIPT_FILENAME = "model.torchscript.pt"
+ONNX_FILENAME = "model.onnx"
+
+
+class TorchScriptEngine:
+    """Runs an exported TorchScript graph.
+
+    Args:
+        path: Path to the TorchScript file.
+        num_threads: Number of intra-op threads for CPU inference.
+    """
+
+    def __init__(self, path: str | Path, num_threads: Optional[int] = None) -> None:
+        import torch
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        extra_files = {"config.json": ""}
+        self.model = torch.jit.load(
+            str(path), map_location="cpu", _extra_files=extra_files
+        )
+        self.model.eval()
+        self.num_inputs = json.loads(extra_files["config.json"])["num_inputs"]
+
+    def predict(self, inputs: AnyType) -> np.ndarray:
+        """Predicts a single request."""
+        return self.predict_batch(np.asarray(inputs, np.float32)[None])[0]
+
+    def predict_batch(self, inputs_batch: AnyType) -> np.ndarray:
+        """Predicts a batch of requests."""
+        import torch
+
+        inputs = torch.from_numpy(np.require(inputs_batch, np.float32, ["C", "W"]))
+        with torch.inference_mode(), span("forward", batch_size=len(inputs)):
+            return self.model(inputs).numpy()
+
+
+class OnnxEngine:
+    """Runs an exported ONNX graph with ONNX Runtime on CPU.
+
+    Args:
+        path: Path to the ONNX file.
+        num_threads: Number of intra-op threads.
+    """
+
+    def __init__(self, path: str | Path, num_threads: Optional[int] = None) -> None:
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx backend needs: pip install onnxruntime")
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            str(path), options, providers=["CPUExecutionProvider"]
+        )
+        self.num_inputs = self.session.get_inputs()[0].shape[-1]
+
+    def predict(self, inputs: AnyType) -> np.ndarray:
+        """Predicts a single request."""
+        return self.predict_batch(np.asarray(inputs, np.float32)[None])[0]
+
+    def predict_batch(self, inputs_batch: AnyType) -> np.ndarray:
+        """Predicts a batch of requests."""
+        inputs = np.ascontiguousarray(inputs_batch, np.float32)
+        with span("forward", batch_size=len(inputs)):
+            return self.session.run(["logits"], {"inputs": inputs})[0]
+
+
+def quantized_filename(precision: str) -> str:
+    """Gets the filename of a quantized variant, see `weather.quantize`."""
+    return f"model.{precision}.pt"
+
+
+def load_engine(
+    model_dir: str | Path,
+    backend: str = "torch",
+    num_threads: Optional[int] = None,
+    batch_sizes: tuple[int, ...] = (1,),
+    precision: str = "fp32",
+    num_workers: Optional[int] = None,
+) -> AnyType:
+    """Loads an engine to serve a model.
+
+    Args:
+        model_dir: Path to a pretrained model directory.
+        backend: One of `BACKENDS`. The exported backends need the model to
+            be exported first with `python -m weather.export <model_dir>`.
+        num_threads: Number of intra-op threads for CPU inference.
+        batch_sizes: Batch sizes to preallocate buffers for, torch backend only.
+        precision: One of `PRECISIONS`. Quantized variants are TorchScript files
+            made with `python -m weather.quantize`, so they can't use onnx.
+        num_workers: Number of worker processes sharing the model, torch backend
+            only, see `weather.pool`. The threads are split between them.
+
+    Returns: An engine with `predict` and `predict_batch` methods.
+    """
+    model_dir = Path(model_dir)
+    if precision != "fp32":
+        if precision not in PRECISIONS or backend == "onnx":
+            raise ValueError(f"Unsupported precision {precision!r} for {backend}")
+        return TorchScriptEngine(model_dir / quantized_filename(precision), num_threads)
+    if backend == "torch":
+        from weather.inference import InferenceEngine
+        from weather.optimize import optimize_for_inference
+        from weather.registry import load_pretrained
+
+        model = optimize_for_inference(load_pretrained(model_dir))
+        if num_workers:
+            from weather.pool import ProcessPoolEngine
+
+            return ProcessPoolEngine(
+                model, num_workers, num_threads, max_batch_size=max(batch_sizes)
+            )
+        return InferenceEngine(
+            model,
+            num_threads=num_threads,
+            batch_sizes=batch_sizes,
+        )
+    if backend == "torchscript":
+        return TorchScriptEngine(model_dir / TORCHSCRIPT_FILENAME, num_threads)
+    if backend == "onnx":
+        return OnnxEngine(model_dir / ONNX_FILENAME, num_threads)
+    raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
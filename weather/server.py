@@ -0,0 +1,304 @@
+"""Prediction server with dynamic micro-batching.
+
+Concurrent requests are queued and grouped into batches of up to
+`max_batch_size` patches, waiting at most `max_delay` seconds for a batch to
+fill up. Each batch runs as a single forward pass, and every caller gets its
+own slice of the predictions back. When the queue is full, new requests are
+rejected right away instead of piling up latency.
+
+To run the server:
+
+    python -m weather.server models/26_100_epochs_tropics --port 8080
+
+Requests are HTTP POSTs to /predict with an NPY body containing a float32
+array with shape (height, width, channels), and the response is an NPY body
+with the predictions with shape (height, width, outputs). Requests must have
+a Content-Length, and larger bodies than `--max-body-bytes` are rejected, as
+are patches smaller than the model's convolution kernel. Stage timings and
+queue stats are served in the Prometheus text format at /metrics.
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import Future
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import logging
+from pathlib import Path
+import queue
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+
+from weather.metrics import metrics, span
+from weather.npy import read_npy
+from weather.runtime import BACKENDS, load_engine
+
+MAX_BODY_BYTES = 64 * 1024**2  # default limit on the size of request bodies
+
+
+class Overloaded(Exception):
+    """Raised when there are too many requests waiting to be predicted."""
+
+
+class MicroBatcher:
+    """Groups concurrent requests into batches for a prediction function.
+
+    Args:
+        predict_batch: Function to predict a batch of inputs.
+        max_batch_size: Maximum number of requests per batch.
+        max_delay: Maximum time in seconds to wait for a batch to fill up.
+        max_queue_depth: Maximum number of requests waiting to be batched.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[np.ndarray], np.ndarray],
+        max_batch_size: int = 8,
+        max_delay: float = 0.005,
+        max_queue_depth: int = 64,
+    ) -> None:
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_depth)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, inputs: np.ndarray) -> Future:
+        """Queues a request to be predicted in the next batch.
+
+        Args:
+            inputs: Inputs of a single request.
+
+        Raises:
+            Overloaded: If the queue is full.
+
+        Returns: A future resolving to the predictions for the request.
+        """
+        future: Future = Future()
+        try:
+            self.queue.put_nowait((inputs, future))
+        except queue.Full:
+            raise Overloaded(f"More than {self.queue.maxsize} requests waiting")
+        return future
+
+    def close(self) -> None:
+        """Stops batching once the requests already queued are done."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self) -> None:
+        """Collects and predicts batches until closed."""
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.queue.put(None)  # stop after this batch
+                    break
+                batch.append(request)
+            self.run_batch(batch)
+
+    def run_batch(self, batch: list[tuple[np.ndarray, Future]]) -> None:
+        """Predicts a batch, grouping requests with the same shape together."""
+        groups: dict[tuple, list[tuple[np.ndarray, Future]]] = {}
+        for inputs, future in batch:
+            if future.set_running_or_notify_cancel():
+                groups.setdefault(inputs.shape, []).append((inputs, future))
+
+        for requests in groups.values():
+            try:
+                with span("batch_stack"):
+                    inputs_batch = np.stack([inputs for inputs, _ in requests])
+                predictions = self.predict_batch(inputs_batch)
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(requests):
+                future.set_result(predictions[i])
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """Handles prediction requests for a `PredictionServer`."""
+
+    server: PredictionServer
+    timeout = 30  # seconds, so clients that stall mid-request are dropped
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != "/health":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self) -> None:
+        if self.path != "/predict":
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.send_error(HTTPStatus.BAD_REQUEST, "Expected a Content-Length")
+            return
+        if length > self.server.max_body_bytes:
+            message = f"Bodies are limited to {self.server.max_body_bytes} bytes"
+            self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, message)
+            return
+
+        try:
+            # The header can't declare more data than the body holds.
+            inputs = read_npy(self.rfile, max_bytes=length)
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        if inputs.shape[-1] != self.server.num_inputs:
+            message = f"Expected {self.server.num_inputs} channels, got {inputs.shape}"
+            self.send_error(HTTPStatus.BAD_REQUEST, message)
+            return
+        min_height, min_width = self.server.min_size
+        if inputs.shape[0] < min_height or inputs.shape[1] < min_width:
+            message = (
+                f"Expected at least {min_height}x{min_width} pixels,"
+                f" got {inputs.shape}"
+            )
+            self.send_error(HTTPStatus.BAD_REQUEST, message)
+            return
+
+        try:
+            future = self.server.batcher.submit(inputs)
+        except Overloaded as e:
+            self.send_response(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            predictions = future.result()
+        except Exception as e:
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+            return
+
+        body = io.BytesIO()
+        np.save(body, predictions, allow_pickle=False)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(body.getbuffer().nbytes))
+        self.end_headers()
+        self.wfile.write(body.getbuffer())
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """HTTP server that predicts requests through a `MicroBatcher`.
+
+    Args:
+        address: A (host, port) pair to listen on.
+        batcher: Batcher to submit the requests to.
+        num_inputs: Number of input channels the model expects.
+        max_body_bytes: Maximum size of a request body.
+        min_size: Smallest (height, width) the model can predict,
+            see `get_min_size`.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: tuple[str, int],
+        batcher: MicroBatcher,
+        num_inputs: int,
+        max_body_bytes: int = MAX_BODY_BYTES,
+        min_size: tuple[int, int] = (1, 1),
+    ) -> None:
+        super().__init__(address, PredictionHandler)
+        self.batcher = batcher
+        self.num_inputs = num_inputs
+        self.max_body_bytes = max_body_bytes
+        self.min_size = min_size
+
+
+def get_min_size(model_dir: str | Path) -> tuple[int, int]:
+    """Gets the smallest (height, width) a model can predict.
+
+    The convolution isn't padded, so patches smaller than its kernel
+    have no pixels left to predict.
+    """
+    config = json.loads((Path(model_dir) / "config.json").read_text())
+    kernel_size = config.get("kernel_size", (3, 3))
+    if isinstance(kernel_size, int):
+        return (kernel_size, kernel_size)
+    height, width = kernel_size
+    return (height, width)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("model", help="Path to a pretrained model directory.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-delay-ms", type=float, default=5.0)
+    parser.add_argument("--max-queue-depth", type=int, default=64)
+    parser.add_argument("--max-body-bytes", type=int, default=MAX_BODY_BYTES)
+    parser.add_argument("--num-threads", type=int, help="Intra-op CPU threads.")
+    parser.add_argument("--workers", type=int, help="Inference worker processes.")
+    parser.add_argument("--backend", choices=BACKENDS, default="torch")
+    args = parser.parse_args()
+
+    engine = load_engine(
+        args.model,
+        args.backend,
+        num_threads=args.num_threads,
+        batch_sizes=(1, args.max_batch_size),
+        num_workers=args.workers,
+    )
+    batcher = MicroBatcher(
+        engine.predict_batch,
+        max_batch_size=args.max_batch_size,
+        max_delay=args.max_delay_ms / 1000,
+        max_queue_depth=args.max_queue_depth,
+    )
+    metrics.register("weather_batcher", lambda: {"queue_depth": batcher.queue.qsize()})
+    server = PredictionServer(
+        (args.host, args.port),
+        batcher,
+        engine.num_inputs,
+        args.max_body_bytes,
+        get_min_size(args.model),
+    )
+    logging.info(f"Serving {args.model} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    finally:
+        batcher.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
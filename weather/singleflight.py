@@ -0,0 +1,69 @@
+"""Coalesces concurrent identical requests into a single computation.
+
+When many callers ask for the same thing at once, like every viewer opening
+the same launch forecast, only the first caller computes it, and the others
+wait for that result instead of repeating the work. Unlike a cache, nothing
+is kept once the computation finishes, so later calls compute it again.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import Future
+import threading
+from typing import Any as AnyType, Callable, Hashable
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, sharing its result."""
+
+    def __init__(self) -> None:
+        self.flights: dict[Hashable, Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def do(
+        self, key: Hashable, fn: Callable[..., AnyType], *args: AnyType
+    ) -> tuple[AnyType, bool]:
+        """Calls a function, or waits for the call already in flight for a key.
+
+        Exceptions are also shared, every waiting caller gets them raised.
+
+        Args:
+            key: Identifies the request, calls with equal keys are coalesced.
+            fn: Function to call.
+            args: Arguments to call the function with.
+
+        Returns: The (result, coalesced) pair, where coalesced is True if the
+            result came from another caller's call. Coalesced results are
+            shared, so they must not be modified.
+        """
+        with self.lock:
+            self.calls += 1
+            flight = self.flights.get(key)
+            if flight is None:
+                leader = self.flights[key] = Future()
+            else:
+                self.coalesced += 1
+        if flight is not None:
+            return (flight.result(), True)
+
+        try:
+            result = fn(*args)
+            leader.set_result(result)
+            return (result, False)
+        except BaseException as e:
+            leader.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+    def stats(self) -> dict[str, int]:
+        """Gets counters to monitor how many calls were coalesced."""
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "in_flight": len(self.flights),
+            }
@@ -0,0 +1,165 @@
+"""Forecasts at several nearby sites from a shared region download.
+
+Launch and recovery sites are close enough that the patches around them
+overlap heavily, so downloading a patch per site mostly downloads the same
+pixels again. Instead, the sites are grouped into regions covering all their
+patches, each region is fetched in a single request on a latitude/longitude
+grid, and the patch of every site is sliced out of its region without
+copying. All the sites are then predicted as one batch.
+
+Sites far apart are split into several regions to stay under the Earth
+Engine download size limit.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any as AnyType, Optional
+
+import numpy as np
+
+from weather.data import (
+    INPUT_BANDS,
+    MAX_REQUEST_BYTES,
+    SCALE,
+    PatchSource,
+    executor,
+    get_forecast_bands,
+    get_forecast_dates,
+    get_patch_source,
+)
+from weather.region import get_pixel_size
+
+
+@dataclass
+class SitesForecast:
+    """Forecasts at several sites, in the order of the points."""
+
+    points: list[tuple]
+    inputs: np.ndarray  # (sites, height, width, channels)
+    predictions: np.ndarray  # (sites, height, width, outputs)
+    labels: Optional[np.ndarray] = None  # (sites, height, width, outputs)
+
+
+def get_sites_region(
+    points: list[tuple], patch_size: int, scale: int = SCALE
+) -> tuple[tuple[float, float, float, float], tuple[int, int], list[tuple[int, int]]]:
+    """Gets the region covering the patches around several points.
+
+    Args:
+        points: A (longitude, latitude) coordinate for each site.
+        patch_size: Size in pixels of the square patch around each site.
+        scale: Number of meters per pixel.
+
+    Returns: The (west, south, east, north) bounds of the region, its
+        (height, width) in pixels, and the (row, col) of each site's patch.
+    """
+    longitudes = [lon for lon, _ in points]
+    latitudes = [lat for _, lat in points]
+    west, east = min(longitudes), max(longitudes)
+    south, north = min(latitudes), max(latitudes)
+    dx, dy = get_pixel_size((west, south, east, north), scale)
+
+    # Snap every site to the pixel grid of the region, with its patch centered.
+    windows = [
+        (round((north - lat) / dy), round((lon - west) / dx)) for lon, lat in points
+    ]
+    height = max(row for row, _ in windows) + patch_size
+    width = max(col for _, col in windows) + patch_size
+    region_west = west - patch_size / 2 * dx
+    region_north = north + patch_size / 2 * dy
+    bounds = (
+        region_west,
+        region_north - height * dy,
+        region_west + width * dx,
+        region_north,
+    )
+    return (bounds, (height, width), windows)
+
+
+def group_sites(
+    points: list[tuple],
+    patch_size: int,
+    num_bands: int,
+    max_bytes: int = MAX_REQUEST_BYTES,
+    scale: int = SCALE,
+) -> list[list[int]]:
+    """Groups sites into regions small enough to download in a single request.
+
+    Args:
+        points: A (longitude, latitude) coordinate for each site.
+        patch_size: Size in pixels of the square patch around each site.
+        num_bands: Number of float32 bands to download.
+        max_bytes: Maximum size of each region's download.
+        scale: Number of meters per pixel.
+
+    Returns: The indices of the points in each group.
+    """
+    groups: list[list[int]] = []
+    order = sorted(range(len(points)), key=lambda i: points[i])
+    for i in order:
+        if groups:
+            group = groups[-1] + [i]
+            _, (height, width), _ = get_sites_region(
+                [points[j] for j in group], patch_size, scale
+            )
+            if height * width * num_bands * 4 <= max_bytes:
+                groups[-1] = group
+                continue
+        groups.append([i])
+    return groups
+
+
+def forecast_sites(
+    engine: AnyType,
+    date: datetime,
+    points: list[tuple],
+    patch_size: int = 128,
+    labels: bool = False,
+    scale: int = SCALE,
+    max_bytes: int = MAX_REQUEST_BYTES,
+    source: Optional[PatchSource] = None,
+) -> SitesForecast:
+    """Forecasts several sites, downloading the pixels they share only once.
+
+    Args:
+        engine: Engine with a `predict_batch` method, see `weather.runtime`.
+        date: The date of interest.
+        points: A (longitude, latitude) coordinate for each site.
+        patch_size: Size in pixels of the square patch around each site.
+        labels: Whether to also get the actual precipitation at every site.
+        scale: Number of meters per pixel.
+        max_bytes: Maximum size of each region's download.
+        source: Where to get the regions from, defaults to `get_patch_source()`.
+
+    Returns: The forecasts at every site.
+    """
+    source = source or get_patch_source()
+    # The labels are stacked with the inputs, so they come in the same request.
+    gpm_dates, goes16_dates = get_forecast_dates(date, labels)
+    input_bands, label_bands = get_forecast_bands(labels)
+    num_bands = len(input_bands) + len(label_bands)
+
+    def fetch(group: list[int]) -> tuple[np.ndarray, list[tuple[int, int]]]:
+        bounds, shape, windows = get_sites_region(
+            [points[i] for i in group], patch_size, scale
+        )
+        region = source.get_stacked_region(gpm_dates, goes16_dates, True, bounds, shape)
+        return (region, windows)
+
+    groups = group_sites(points, patch_size, num_bands, max_bytes, scale)
+    inputs = np.empty((len(points), patch_size, patch_size, INPUT_BANDS), np.float32)
+    actual = np.empty(
+        (len(points), patch_size, patch_size, len(label_bands)), np.float32
+    )
+    for group, (region, windows) in zip(groups, executor.map(fetch, groups)):
+        for i, (row, col) in zip(group, windows):
+            # A view into the region, only copied once into the batch.
+            patch = region[row : row + patch_size, col : col + patch_size]
+            np.take(patch, input_bands, axis=-1, out=inputs[i])
+            if labels:
+                np.take(patch, label_bands, axis=-1, out=actual[i])
+
+    predictions = engine.predict_batch(inputs)
+    return SitesForecast(points, inputs, predictions, actual if labels else None)
@@ -0,0 +1,190 @@
+"""Streaming per-channel statistics over datasets that don't fit in memory.
+
+The mean and standard deviation are accumulated one batch at a time, and
+partial statistics are merged with the parallel algorithm from Chan et al.:
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+
+This gives the same results as `np.mean` and `np.std` over the whole dataset,
+while only one batch is in memory at a time. Shards of the dataset can also be
+processed in separate worker processes, and their statistics merged at the end.
+Workers open the examples themselves from memory-mapped files, instead of
+getting a pickled copy of the whole dataset with every shard.
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import mmap
+from pathlib import Path
+from typing import Any as AnyType, Callable, Iterator, Optional
+
+import numpy as np
+
+
+class ChannelStats:
+    """Running count, mean and sum of squared deviations of each channel.
+
+    Args:
+        num_channels: Number of channels, the last axis of the data.
+    """
+
+    def __init__(self, num_channels: int) -> None:
+        self.count = 0
+        self.mean = np.zeros(num_channels, np.float64)
+        self.m2 = np.zeros(num_channels, np.float64)
+
+    @property
+    def std(self) -> np.ndarray:
+        """Population standard deviation of each channel, like `np.std`."""
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def update(self, batch: np.ndarray) -> None:
+        """Adds a batch of data with channels in the last axis."""
+        values = batch.reshape(-1, batch.shape[-1])
+        other = ChannelStats(values.shape[-1])
+        other.count = values.shape[0]
+        other.mean = values.mean(axis=0, dtype=np.float64)
+        other.m2 = np.square(values - other.mean).sum(axis=0)
+        self.merge(other)
+
+    def merge(self, other: ChannelStats) -> None:
+        """Adds the statistics of other data."""
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta**2 * (self.count * other.count / count)
+        self.count = count
+
+
+def iter_batches(
+    inputs: AnyType, start: int, stop: int, batch_size: int, column: str
+) -> Iterator[np.ndarray]:
+    """Reads a range of examples in batches.
+
+    Args:
+        inputs: Sliceable examples, like a NumPy array or a Hugging Face dataset.
+        start: Index of the first example.
+        stop: Index after the last example.
+        batch_size: Number of examples per batch.
+        column: Column to read if slices of `inputs` are dicts.
+
+    Returns: An iterator of float32 batches.
+    """
+    for i in range(start, stop, batch_size):
+        batch = inputs[i : min(i + batch_size, stop)]
+        if isinstance(batch, dict):
+            batch = batch[column]
+        yield np.asarray(batch, np.float32)
+
+
+def get_opener(inputs: AnyType) -> Callable[[], AnyType] | AnyType:
+    """Gets what a worker process needs to open the examples without copying them.
+
+    Args:
+        inputs: Path of a `.npy` file, a memory-mapped NumPy array,
+            or a Hugging Face dataset backed by Arrow files on disk.
+
+    Raises:
+        ValueError: If the examples are in memory, so they would be copied.
+
+    Returns: A function opening the examples, or a dataset that
+        pickles as a reference to its files.
+    """
+    if isinstance(inputs, (str, Path)):
+        return partial(np.load, inputs, mmap_mode="r")
+    if isinstance(inputs, np.memmap):
+        # Views of a memory-mapped array don't keep track of their offset.
+        if not isinstance(inputs.base, mmap.mmap):
+            raise ValueError("Pass the path of the array instead of a view of it")
+        order = "F" if inputs.flags.f_contiguous and inputs.ndim > 1 else "C"
+        return partial(
+            np.memmap,
+            inputs.filename,
+            inputs.dtype,
+            "r",
+            inputs.offset,
+            inputs.shape,
+            order,
+        )
+    if getattr(inputs, "cache_files", None):
+        return inputs
+    raise ValueError(
+        "Worker processes need memory-mapped examples, like the path of a `.npy`"
+        f" file or a Hugging Face dataset on disk, got {type(inputs).__name__}"
+    )
+
+
+def compute_shard_stats(
+    inputs: AnyType, start: int, stop: int, batch_size: int, column: str
+) -> Optional[ChannelStats]:
+    """Computes the statistics of a range of examples, see `iter_batches`.
+
+    The examples can also be a function opening them, see `get_opener`.
+    """
+    if callable(inputs):
+        inputs = inputs()
+    stats = None
+    for batch in iter_batches(inputs, start, stop, batch_size, column):
+        if stats is None:
+            stats = ChannelStats(batch.shape[-1])
+        stats.update(batch)
+    return stats
+
+
+def compute_stats(
+    inputs: AnyType,
+    batch_size: int = 16,
+    num_workers: Optional[int] = None,
+    column: str = "inputs",
+) -> ChannelStats:
+    """Computes the per-channel mean and standard deviation of a dataset.
+
+    Args:
+        inputs: Sliceable examples with channels in the last axis, like
+            a NumPy array or a Hugging Face dataset formatted as NumPy,
+            or the path of a `.npy` file.
+        batch_size: Number of examples to read at a time.
+        num_workers: Number of worker processes, each processing a shard.
+            The examples are read in the main process if not set, otherwise
+            they must be memory-mapped, see `get_opener`.
+        column: Column to read if slices of `inputs` are dicts.
+
+    Raises:
+        ValueError: If there are no examples, or if they're in memory
+            with `num_workers` set.
+
+    Returns: The statistics of the whole dataset.
+    """
+    opener = None
+    if num_workers and num_workers > 1:
+        opener = get_opener(inputs)
+    if isinstance(inputs, (str, Path)):
+        inputs = np.load(inputs, mmap_mode="r")
+    size = len(inputs)
+    if size == 0:
+        raise ValueError("Cannot compute statistics of an empty dataset")
+    if opener is None:
+        return compute_shard_stats(inputs, 0, size, batch_size, column)
+
+    shard_size = -(-size // num_workers)  # ceiling division
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [
+            pool.submit(
+                compute_shard_stats,
+                opener,
+                start,
+                min(start + shard_size, size),
+                batch_size,
+                column,
+            )
+            for start in range(0, size, shard_size)
+        ]
+        shards = [future.result() for future in futures]
+
+    stats = shards[0]
+    for shard in shards[1:]:
+        stats.merge(shard)
+    return stats
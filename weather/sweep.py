@@ -0,0 +1,161 @@
+"""Forecasts at every step of a time window, like a launch window.
+
+Forecasts at nearby times share most of their frames: with 30 minute steps,
+the input frames at T-4h, T-2h and T of one forecast are also inputs of the
+forecasts 2 and 4 hours later. A sweep collects the unique frames of every
+forecast time, fetches each of them only once in a few stacked requests,
+assembles the inputs of every forecast from them, and predicts them all as
+one batch.
+
+Long windows have more frames than Earth Engine returns in one request, so
+the frames are split into requests under `MAX_REQUEST_BYTES`, fetched
+concurrently.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any as AnyType, Optional
+
+import numpy as np
+
+from weather.data import (
+    GOES16_BANDS,
+    INPUT_HOUR_DELTAS,
+    MAX_REQUEST_BYTES,
+    OUTPUT_HOUR_DELTAS,
+    PatchSource,
+    executor,
+    get_patch_source,
+)
+
+
+@dataclass
+class Sweep:
+    """Forecasts over a time window, ordered by time."""
+
+    dates: list[datetime]
+    predictions: np.ndarray  # (times, height, width, outputs)
+    labels: Optional[np.ndarray] = None  # (times, height, width, outputs)
+
+
+def get_sweep_dates(
+    start: datetime, window: timedelta, step: timedelta
+) -> list[datetime]:
+    """Gets the forecast times from the start to the end of a window, inclusive."""
+    steps = int(window / step)
+    return [start + i * step for i in range(steps + 1)]
+
+
+def get_frame_requests(
+    gpm_dates: list[datetime],
+    goes16_dates: list[datetime],
+    patch_size: int,
+    max_bytes: int = MAX_REQUEST_BYTES,
+) -> list[tuple[list[datetime], list[datetime], bool]]:
+    """Splits the frames of a sweep into stacked requests under a size limit.
+
+    Precipitation and cloud and moisture frames are never mixed in a request,
+    so each request is a contiguous range of bands of the whole stacked patch,
+    with the elevation band at the end of the last one.
+
+    Args:
+        gpm_dates: Dates of the precipitation frames.
+        goes16_dates: Dates of the cloud and moisture frames.
+        patch_size: Size in pixels of the square patch.
+        max_bytes: Maximum size of each request's download.
+
+    Returns: The (gpm_dates, goes16_dates, elevation) of every request,
+        like the arguments of `PatchSource.get_stacked_patch`.
+    """
+    band_bytes = patch_size * patch_size * 4
+    max_bands = max(max_bytes // band_bytes, GOES16_BANDS + 1)
+    max_frames = max_bands // GOES16_BANDS
+    requests = [
+        (gpm_dates[i : i + max_bands], [], False)
+        for i in range(0, len(gpm_dates), max_bands)
+    ]
+    requests += [
+        ([], goes16_dates[i : i + max_frames], False)
+        for i in range(0, len(goes16_dates), max_frames)
+    ]
+    if requests:
+        last_gpm, last_goes16, _ = requests[-1]
+        if len(last_gpm) + len(last_goes16) * GOES16_BANDS < max_bands:
+            requests[-1] = (last_gpm, last_goes16, True)
+            return requests
+    return requests + [([], [], True)]
+
+
+def forecast_sweep(
+    engine: AnyType,
+    dates: list[datetime],
+    point: tuple,
+    patch_size: int = 128,
+    labels: bool = False,
+    source: Optional[PatchSource] = None,
+    max_bytes: int = MAX_REQUEST_BYTES,
+) -> Sweep:
+    """Forecasts a point at several times, fetching each frame only once.
+
+    Args:
+        engine: Engine with a `predict_batch` method, see `weather.runtime`.
+        dates: Forecast times.
+        point: A (longitude, latitude) coordinate.
+        patch_size: Size in pixels of the surrounding square patch.
+        labels: Whether to also get the actual precipitation at every time.
+        source: Where to get the frames from, defaults to `get_patch_source()`.
+        max_bytes: Maximum size of each request's download.
+
+    Returns: The forecasts at every time.
+    """
+    source = source or get_patch_source()
+    input_dates = [[d + timedelta(hours=h) for h in INPUT_HOUR_DELTAS] for d in dates]
+    label_dates = [[d + timedelta(hours=h) for h in OUTPUT_HOUR_DELTAS] for d in dates]
+
+    # GPM frames are both inputs and labels, GOES 16 frames are only inputs.
+    goes16_dates = sorted({d for ds in input_dates for d in ds})
+    gpm_dates = set(goes16_dates)
+    if labels:
+        gpm_dates.update(d for ds in label_dates for d in ds)
+    gpm_dates = sorted(gpm_dates)
+
+    # Every request fills a contiguous range of bands of the stacked frames.
+    requests = get_frame_requests(gpm_dates, goes16_dates, patch_size, max_bytes)
+    num_bands = len(gpm_dates) + len(goes16_dates) * GOES16_BANDS + 1
+    frames = np.empty((patch_size, patch_size, num_bands), np.float32)
+
+    def fetch(request: tuple[list[datetime], list[datetime], bool]) -> np.ndarray:
+        return source.get_stacked_patch(*request, point, patch_size)
+
+    start = 0
+    for patch in executor.map(fetch, requests):
+        frames[:, :, start : start + patch.shape[-1]] = patch
+        start += patch.shape[-1]
+
+    # Map each frame to its bands in the stacked patch.
+    gpm_bands = {date: i for i, date in enumerate(gpm_dates)}
+    goes16_start = len(gpm_dates)
+    goes16_bands = {
+        date: goes16_start + i * GOES16_BANDS for i, date in enumerate(goes16_dates)
+    }
+    elevation_band = goes16_start + len(goes16_dates) * GOES16_BANDS
+
+    # Assemble the inputs of every forecast in the band order of the model.
+    input_bands = np.array(
+        [
+            [gpm_bands[d] for d in ds]
+            + [goes16_bands[d] + b for d in ds for b in range(GOES16_BANDS)]
+            + [elevation_band]
+            for ds in input_dates
+        ]
+    )
+    inputs = np.ascontiguousarray(frames[:, :, input_bands].transpose(2, 0, 1, 3))
+    predictions = engine.predict_batch(inputs)
+
+    if not labels:
+        return Sweep(dates, predictions)
+    label_bands = np.array([[gpm_bands[d] for d in ds] for ds in label_dates])
+    actual = np.ascontiguousarray(frames[:, :, label_bands].transpose(2, 0, 1, 3))
+    return Sweep(dates, predictions, actual)